@@ -0,0 +1,411 @@
+from utils import read_config, read_aoi
+import os
+import sys
+import json
+import math
+import fcntl
+from contextlib import contextmanager, ExitStack
+from datetime import date
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+# Same grid as predict_indexed.py
+RES = 0.00008983
+NODATA = 255
+
+# Rows of a product read at a time
+BLOCK_ROWS = 512
+
+# Per-pixel layers: observations, water observations, last water day (days since 1970-01-01, 0 never)
+LAYERS = {'obs_count': np.uint16, 'water_count': np.uint16, 'last_water': np.int32}
+
+
+def init_accumulator(acc_dir, shp_path, res=RES):
+    """Create empty memory-mapped layers on the AOI grid, if they don't exist"""
+
+    acc_dir = Path(acc_dir)
+    grid_path = acc_dir / 'grid.json'
+    if grid_path.is_file():
+        return
+
+    acc_dir.mkdir(parents=True, exist_ok=True)
+
+    min_x, min_y, max_x, max_y = read_aoi(shp_path).bounds
+    left, top = math.floor(min_x / res) * res, math.ceil(max_y / res) * res
+    width = round((math.ceil(max_x / res) * res - left) / res)
+    height = round((top - math.floor(min_y / res) * res) / res)
+
+    for name, dtype in LAYERS.items():
+        layer = np.lib.format.open_memmap(acc_dir / f'{name}.npy', mode='w+', dtype=dtype, shape=(height, width))
+        layer.flush()
+        del layer
+
+    with open(acc_dir / 'applied.json', 'w') as f:
+        json.dump({}, f)
+
+    with open(grid_path, 'w') as f:
+        json.dump({'left': left, 'top': top, 'res': res, 'width': width, 'height': height}, f)
+
+@contextmanager
+def locked(acc_dir, shared=False):
+    """Hold a lock on the accumulator while updating (exclusive) or reading (shared) it.
+    Serializes the read-modify-write of the layers and applied.json between the
+    predict threads of one process as well as between processes"""
+
+    with open(Path(acc_dir) / '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def open_accumulator(acc_dir, mode='r+'):
+    """Returns the grid, the memory-mapped layers and the applied products.
+    Opened for writing, an interrupted update is recovered first"""
+
+    acc_dir = Path(acc_dir)
+
+    with open(acc_dir / 'grid.json') as f:
+        grid = json.load(f)
+    with open(acc_dir / 'applied.json') as f:
+        applied = json.load(f)
+
+    if mode != 'r':
+        applied = recover(acc_dir, applied)
+
+    layers = {name: np.load(acc_dir / f'{name}.npy', mmap_mode=mode) for name in LAYERS}
+
+    return grid, layers, applied
+
+def save_applied(acc_dir, applied):
+    """Atomically and durably write the applied products"""
+
+    path = Path(acc_dir) / 'applied.json'
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(applied, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f'{path}.tmp', path)
+
+def grid_offset(src, grid):
+    """Row and column of the accumulator grid where an open result image starts"""
+
+    res = grid['res']
+    return round((grid['top'] - src.transform.f) / res), round((src.transform.c - grid['left']) / res)
+
+def product_window(result_path, grid):
+    """Grid rows and columns [r0, r1, c0, c1] covered by a result image, None if it is outside the grid"""
+
+    with rasterio.open(result_path) as src:
+        row_off, col_off = grid_offset(src, grid)
+        height, width = src.height, src.width
+
+    r0, r1 = max(row_off, 0), min(row_off + height, grid['height'])
+    c0, c1 = max(col_off, 0), min(col_off + width, grid['width'])
+    if r1 <= r0 or c1 <= c0:
+        return None
+
+    return [r0, r1, c0, c1]
+
+def intersects(window, rows, cols):
+    """Whether a product window overlaps the rows, cols slices of the grid"""
+
+    return window is not None and window[0] < rows.stop and rows.start < window[1] \
+        and window[2] < cols.stop and cols.start < window[3]
+
+def product_blocks(result_path, grid):
+    """Yield the blocks of a result image with their (row, col) slices on the accumulator grid"""
+
+    with rasterio.open(result_path) as src:
+        row_off, col_off = grid_offset(src, grid)
+
+        # Columns of the product inside the grid
+        c0, c1 = max(0, -col_off), min(src.width, grid['width'] - col_off)
+        if c1 <= c0:
+            return
+
+        for r in range(0, src.height, BLOCK_ROWS):
+            # Rows of the block inside the grid
+            r0 = max(r, -row_off)
+            r1 = min(r + BLOCK_ROWS, src.height, grid['height'] - row_off)
+            if r1 <= r0:
+                continue
+
+            block = src.read(1, window=Window(c0, r0, c1 - c0, r1 - r0))
+            yield block, (slice(r0 + row_off, r1 + row_off), slice(c0 + col_off, c1 + col_off))
+
+def to_day(dt):
+    """Days since 1970-01-01 of a date"""
+    return (dt - date(1970, 1, 1)).days
+
+def apply_product(layers, grid, result_path, day):
+    """Add the counts and last water day of a result image to the layers"""
+
+    for block, (rows, cols) in product_blocks(result_path, grid):
+        valid = block != NODATA
+        water = block == 1
+
+        layers['obs_count'][rows, cols] += valid
+        layers['water_count'][rows, cols] += water
+
+        last = layers['last_water'][rows, cols]
+        layers['last_water'][rows, cols] = np.where(water, np.maximum(last, day), last)
+
+def recover(acc_dir, applied):
+    """Rebuild the layers from the applied results if an update was interrupted.
+    Products being added are completed, products being removed are left out.
+    Returns the applied products"""
+
+    if not any('pending' in product for product in applied.values()):
+        return applied
+
+    print(f'Accumulator update in {acc_dir} was interrupted, rebuilding it from the applied results')
+
+    with open(Path(acc_dir) / 'grid.json') as f:
+        grid = json.load(f)
+    layers = {name: np.load(Path(acc_dir) / f'{name}.npy', mmap_mode='r+') for name in LAYERS}
+    for layer in layers.values():
+        layer[:] = 0
+
+    rebuilt = {}
+    for title, product in applied.items():
+        if product.get('pending') == 'remove':
+            continue
+        if not os.path.isfile(product['path']):
+            print(f"{product['path']} is missing, {title} left out of the accumulator")
+            continue
+
+        apply_product(layers, grid, product['path'], product['day'])
+        rebuilt[title] = {key: value for key, value in product.items() if key != 'pending'}
+
+    for layer in layers.values():
+        layer.flush()
+
+    save_applied(acc_dir, rebuilt)
+
+    return rebuilt
+
+def add_product(acc_dir, title, result_path, dt):
+    """Add a predicted product to the accumulators, in place.
+    It is recorded as pending before the layers change, so an interrupted update
+    is recovered by rebuilding instead of counting the product twice.
+    Returns False if it had already been added"""
+
+    with locked(acc_dir):
+        grid, layers, applied = open_accumulator(acc_dir)
+        if title in applied:
+            return False
+
+        day = to_day(dt)
+
+        applied[title] = {'path': str(result_path), 'day': day, 'window': product_window(result_path, grid),
+                          'pending': 'add'}
+        save_applied(acc_dir, applied)
+
+        apply_product(layers, grid, result_path, day)
+
+        for layer in layers.values():
+            layer.flush()
+
+        del applied[title]['pending']
+        save_applied(acc_dir, applied)
+
+        return True
+
+def remove_product(acc_dir, title):
+    """Roll a product back out of the accumulators, in place.
+    Pixels whose last water date came from it get the date of the most recent remaining product"""
+
+    with locked(acc_dir):
+        grid, layers, applied = open_accumulator(acc_dir)
+        if title not in applied:
+            return False
+
+        applied[title]['pending'] = 'remove'
+        save_applied(acc_dir, applied)
+
+        product = applied.pop(title)
+        day = product['day']
+
+        others = newest_first(applied, grid)
+
+        for block, (rows, cols) in product_blocks(product['path'], grid):
+            valid = block != NODATA
+            water = block == 1
+
+            layers['obs_count'][rows, cols] -= valid
+            layers['water_count'][rows, cols] -= water
+
+            # Pixels to resolve from the remaining products
+            last = layers['last_water'][rows, cols]
+            stale = water & (last == day)
+            if stale.any():
+                layers['last_water'][rows, cols] = last_water_from(others, grid, rows, cols, last, stale)
+
+        for layer in layers.values():
+            layer.flush()
+
+        save_applied(acc_dir, applied)
+
+        return True
+
+def replace_product(acc_dir, title, result_path, dt, new_path):
+    """Move the new result new_path of a (re-)detected product to result_path and update the
+    accumulators from its previous result, if it had been added, in one pass over both.
+    Only pixels that were water in the previous result but not in the new one, with it as
+    their last water day, are looked up in the other products overlapping the block.
+    Returns True if a previous result was replaced"""
+
+    with locked(acc_dir):
+        grid, layers, applied = open_accumulator(acc_dir)
+        previous = applied.get(title)
+        day = to_day(dt)
+
+        new_window = product_window(new_path, grid)
+        old_window = None
+        if previous:
+            old_window = previous['window'] if 'window' in previous else product_window(previous['path'], grid)
+
+        # Until the new result is in place, an interrupted update is rebuilt from the previous one
+        applied[title] = {'path': str(result_path), 'day': day, 'window': new_window, 'pending': 'add'}
+        save_applied(acc_dir, applied)
+
+        others = newest_first({t: p for t, p in applied.items() if t != title}, grid)
+
+        # Union of the previous and new results on the grid
+        windows = [w for w in (old_window, new_window) if w] or [[0, 0, 0, 0]]
+        r_start, r_stop = min(w[0] for w in windows), max(w[1] for w in windows)
+        cols = slice(min(w[2] for w in windows), max(w[3] for w in windows))
+        old_day = previous['day'] if previous else day
+
+        with ExitStack() as stack:
+            old_src = stack.enter_context(rasterio.open(previous['path'])) if old_window else None
+            new_src = stack.enter_context(rasterio.open(new_path)) if new_window else None
+
+            for r in range(r_start, r_stop, BLOCK_ROWS):
+                rows = slice(r, min(r + BLOCK_ROWS, r_stop))
+                old = read_src_window(old_src, grid, rows, cols)
+                new = read_src_window(new_src, grid, rows, cols)
+
+                old_water, new_water = old == 1, new == 1
+
+                # Added before subtracting, the unsigned counts never go below zero
+                layers['obs_count'][rows, cols] += new != NODATA
+                layers['obs_count'][rows, cols] -= old != NODATA
+                layers['water_count'][rows, cols] += new_water
+                layers['water_count'][rows, cols] -= old_water
+
+                last = layers['last_water'][rows, cols]
+                stale = old_water & ~new_water & (last == old_day)
+                last = np.where(new_water, np.maximum(last, day), last)
+                if stale.any():
+                    last = last_water_from(others, grid, rows, cols, last, stale)
+                layers['last_water'][rows, cols] = last
+
+        for layer in layers.values():
+            layer.flush()
+
+        os.replace(new_path, result_path)
+
+        del applied[title]['pending']
+        save_applied(acc_dir, applied)
+
+        return previous is not None
+
+def newest_first(applied, grid):
+    """Applied products newest first, recording the grid window of those added without it"""
+
+    for product in applied.values():
+        if 'window' not in product:
+            product['window'] = product_window(product['path'], grid) if os.path.isfile(product['path']) else None
+
+    return sorted(applied.values(), key=lambda p: p['day'], reverse=True)
+
+def last_water_from(others, grid, rows, cols, last, stale):
+    """Last water day of the stale pixels of a block from the newest of the other products
+    that saw water there, 0 if none did. Products outside the block aren't read"""
+
+    last = np.where(stale, 0, last)
+    stale = stale.copy()
+
+    for other in others:
+        if not stale.any():
+            break
+        if not intersects(other['window'], rows, cols):
+            continue
+
+        found = stale & (read_window(other['path'], grid, rows, cols) == 1)
+        last[found] = other['day']
+        stale &= ~found
+
+    return last
+
+def read_src_window(src, grid, rows, cols):
+    """Read the accumulator grid window rows, cols from an open result image, NODATA outside it or without one"""
+
+    out = np.full((rows.stop - rows.start, cols.stop - cols.start), NODATA, dtype=np.uint8)
+    if src is None:
+        return out
+
+    row_off, col_off = grid_offset(src, grid)
+
+    # Window in the result image coordinates, clipped to it
+    r0, r1 = max(rows.start - row_off, 0), min(rows.stop - row_off, src.height)
+    c0, c1 = max(cols.start - col_off, 0), min(cols.stop - col_off, src.width)
+    if r1 <= r0 or c1 <= c0:
+        return out
+
+    out[r0 + row_off - rows.start:r1 + row_off - rows.start, c0 + col_off - cols.start:c1 + col_off - cols.start] = \
+        src.read(1, window=Window(c0, r0, c1 - c0, r1 - r0))
+
+    return out
+
+def read_window(result_path, grid, rows, cols):
+    """Read the accumulator grid window rows, cols from a result image, NODATA outside it"""
+
+    with rasterio.open(result_path) as src:
+        return read_src_window(src, grid, rows, cols)
+
+def export_frequency(acc_dir, out_path):
+    """Write the water frequency (water / observations, 0-100 %) as a GeoTIFF"""
+
+    grid, layers, _ = open_accumulator(acc_dir, mode='r')
+    transform = from_origin(grid['left'], grid['top'], grid['res'], grid['res'])
+
+    # No update runs while the counts are read
+    with locked(acc_dir, shared=True), \
+            rasterio.open(out_path, 'w', driver='GTiff', width=grid['width'], height=grid['height'],
+                          count=1, dtype='uint8', crs='epsg:4326', transform=transform, nodata=NODATA,
+                          tiled=True, compress='LZW', BIGTIFF='IF_SAFER') as dst:
+        for r in range(0, grid['height'], BLOCK_ROWS):
+            obs = layers['obs_count'][r:r + BLOCK_ROWS]
+            water = layers['water_count'][r:r + BLOCK_ROWS]
+
+            # Pixels never observed stay nodata
+            freq = np.full(obs.shape, NODATA, dtype=np.uint8)
+            seen = obs > 0
+            freq[seen] = np.rint(water[seen] * 100.0 / obs[seen])
+
+            dst.write(freq, 1, window=Window(0, r, grid['width'], freq.shape[0]))
+
+
+if __name__ == '__main__':
+    # python accumulator.py rollback <title>
+    # python accumulator.py frequency <out.tif>
+    config = read_config('config.ini')
+    acc_dir = config['Predict']['Accumulator']
+
+    if len(sys.argv) == 3 and sys.argv[1] == 'rollback':
+        if remove_product(acc_dir, sys.argv[2]):
+            print(f'Rolled back {sys.argv[2]}')
+        else:
+            print(f'{sys.argv[2]} is not in the accumulator')
+    elif len(sys.argv) == 3 and sys.argv[1] == 'frequency':
+        export_frequency(acc_dir, sys.argv[2])
+        print(f'Water frequency written to {sys.argv[2]}')
+    else:
+        print('Usage: accumulator.py rollback <title> | frequency <out.tif>')
@@ -0,0 +1,177 @@
+"""End-to-end ingest benchmark against the offline Scihub stand-in.
+
+Runs sync_s1_products.py and download_products.py in a scratch workspace
+pointed at mock_scihub and reports products/s, MB/s and the retry counts
+the stages record in the product_metrics table.
+"""
+import argparse
+import configparser
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import fiona
+from shapely import wkt
+from shapely.geometry import mapping
+
+from mock_scihub import MockScihub, start_server, FOOTPRINT
+from product_state import status_schema
+from metrics import METRICS_SCHEMA
+
+CODE_DIR = Path(__file__).resolve().parent
+
+
+def create_workspace(work_dir, url, download_options):
+    """Create config.ini, database and AOI files of a scratch deployment"""
+
+    work_dir = Path(work_dir)
+    for folder in ('Download', 'Preprocess', 'Temporary', 'Results'):
+        (work_dir / folder).mkdir(parents=True, exist_ok=True)
+
+    # AOI slightly smaller than the mock footprints
+    aoi = wkt.loads(FOOTPRINT).buffer(-0.1)
+    shp_path = work_dir / 'aoi.shp'
+    schema = {'geometry': 'Polygon', 'properties': {'id': 'int'}}
+    with fiona.open(shp_path, 'w', driver='ESRI Shapefile', schema=schema, crs='EPSG:4326') as c:
+        c.write({'geometry': mapping(aoi), 'properties': {'id': 1}})
+    with open(work_dir / 'aoi_api.txt', 'w') as f:
+        f.write(str(aoi.simplify(0.08)))
+
+    config = configparser.ConfigParser()
+    config.read(CODE_DIR / 'config.ini')
+    config['Path']['Database'] = str(work_dir / 'bench.db')
+    for folder in ('Download', 'Preprocess', 'Temporary', 'Results'):
+        config['Path'][folder] = str(work_dir / folder) + '/'
+    config['Scihub']['Url'] = url
+    config['Scihub']['Date_From'] = '2000-01-01T00:00:00Z'
+    config['Scihub']['Date_To'] = 'NOW'
+    config['Preprocess']['SHP'] = str(shp_path)
+    for key, value in download_options.items():
+        config['Download'][key] = str(value)
+    config['Scihub']['Backoff'] = str(download_options.get('Backoff', 2))
+
+    with open(work_dir / 'config.ini', 'w') as f:
+        config.write(f)
+
+    # Same schema as init_app.py
+    con = sqlite3.connect(config['Path']['Database'])
+    con.execute('''CREATE TABLE {} (id VARCHAR PRIMARY KEY, title VARCHAR, filename VARCHAR,
+        beginposition VARCHAR, endposition VARCHAR, orbitnumber INTEGER, orbitdirection VARCHAR,
+        footprint VARCHAR, info_link VARCHAR, dl_link VARCHAR, checksum VARCHAR, downloaded INTEGER,
+        preprocessed INTEGER, indexed INTEGER, detected INTEGER, coverage FLOAT, classifier_fp VARCHAR,
+        result_fp VARCHAR, status VARCHAR, lease_owner VARCHAR, lease_expires FLOAT) WITHOUT ROWID'''.format(config['Database']['Table']))
+    for statement in status_schema(config['Database']['Table']):
+        con.execute(statement)
+    con.execute(METRICS_SCHEMA)
+    con.commit()
+    con.execute('PRAGMA journal_mode={}'.format(config['Database'].get('Journal_Mode', 'WAL')))
+    con.close()
+
+    return config
+
+def run_stage(script, work_dir):
+    """Run a pipeline script in the workspace. Returns its wall time and exit code"""
+
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, str(CODE_DIR / script)], cwd=work_dir,
+                          capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+
+    if proc.returncode != 0:
+        print(f'{script} exited with {proc.returncode}')
+        print(proc.stdout)
+        print(proc.stderr)
+
+    return elapsed, proc.returncode
+
+def stage_counts(con, stage):
+    """Sums of the metrics the products of a stage recorded"""
+    return dict(con.execute('SELECT name, SUM(value) FROM product_metrics WHERE stage = ? GROUP BY name', (stage,)).fetchall())
+
+def run_benchmark(mock, work_dir, download_options):
+    """Sync and download every mock product, returns the measured results"""
+
+    server = start_server(mock)
+    url = f'http://127.0.0.1:{server.server_port}/'
+
+    try:
+        config = create_workspace(work_dir, url, download_options)
+
+        sync_time, sync_code = run_stage('sync_s1_products.py', work_dir)
+        sync_stats = dict(mock.stats)
+
+        dl_time, dl_code = run_stage('download_products.py', work_dir)
+        dl_stats = {key: mock.stats[key] - sync_stats[key] for key in mock.stats}
+    finally:
+        server.shutdown()
+
+    con = sqlite3.connect(config['Path']['Database'])
+    synced, downloaded = con.execute('SELECT COUNT(*), SUM(downloaded) FROM {}'.format(config['Database']['Table'])).fetchone()
+    sync_counts = stage_counts(con, 'sync')
+    dl_counts = stage_counts(con, 'download')
+    con.close()
+
+    mb = dl_stats['bytes_sent'] / 1024 / 1024
+
+    return {
+        'products': len(mock.products),
+        'sync': {
+            'exit_code': sync_code,
+            'seconds': round(sync_time, 3),
+            'products': synced,
+            'products_per_s': round(synced / sync_time, 2),
+            'requests': sync_stats['requests'],
+            'errors': sync_stats['errors'],
+            'retries': int(sync_counts.get('retries', 0)),
+            'failed_pages': int(sync_counts.get('failed_pages', 0)),
+        },
+        'download': {
+            'exit_code': dl_code,
+            'seconds': round(dl_time, 3),
+            'products': downloaded or 0,
+            'products_per_s': round((downloaded or 0) / dl_time, 2),
+            'mb': round(mb, 2),
+            'mb_per_s': round(mb / dl_time, 2),
+            'requests': dl_stats['requests'],
+            'errors': dl_stats['errors'],
+            'drops': dl_stats['drops'],
+            'range_requests': dl_stats['range_requests'],
+            'retries': int(dl_counts.get('retries', 0)),
+        },
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark sync and download against the mock Scihub')
+    parser.add_argument('--products', type=int, default=20)
+    parser.add_argument('--payload-mb', type=float, default=2)
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds added to every request')
+    parser.add_argument('--bandwidth-mb', type=float, default=0, help='MB/s per connection, 0 for unlimited')
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--drop-rate', type=float, default=0)
+    parser.add_argument('--workers', type=int, default=1, help='[Download] Workers')
+    parser.add_argument('--backoff', type=float, default=0.1, help='[Download] Backoff')
+    parser.add_argument('--keep', help='Workspace folder to keep instead of a temporary one')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    mock = MockScihub(args.products, int(args.payload_mb * 1024 * 1024), args.latency,
+                      int(args.bandwidth_mb * 1024 * 1024), args.error_rate, args.drop_rate)
+    download_options = {'Workers': args.workers, 'Connections_Per_Host': args.workers, 'Backoff': args.backoff}
+
+    if args.keep:
+        results = run_benchmark(mock, args.keep, download_options)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = run_benchmark(mock, work_dir, download_options)
+
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
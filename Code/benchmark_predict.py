@@ -0,0 +1,333 @@
+"""Synthetic raster benchmark of the prediction path.
+
+Generates VV/VH dB scenes with water bodies and nodata borders, then times
+predict_water, the morphology cleanup and the tiled path of predict_product
+(plan_tiles, predict_tile, run_tiles with windowed writes, global_cleanup)
+in isolation, served from memory by a stand-in for the datacube.
+create_gt_img and merge_images, the former chunked path, are kept only to
+compare against. Reports pixels/s and peak memory per scene size and flags
+regressions against a saved baseline.
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+import xarray as xr
+from scipy import ndimage
+from joblib import load
+from sklearn.ensemble import RandomForestClassifier
+
+from predict_indexed import (predict_water, clean_water, create_gt_img, merge_images, output_grid, plan_tiles,
+                             predict_tile, predict_product, global_cleanup, bytes_per_pixel, RES)
+from model_lut import compile_lut
+from metrics import lifetime_peak_rss_mb
+
+# Mean and spread (dB) of the backscatter of water and land
+WATER_DB = {'VH': (-24, 1.5), 'VV': (-18, 1.5)}
+LAND_DB = {'VH': (-15, 2.5), 'VV': (-8, 2.5)}
+
+
+def make_scene(size, nodata_fraction=0.1, water_fraction=0.2, seed=0):
+    """Synthetic scene of size x size pixels as the datacube would load it.
+    Water forms smooth blobs, nodata is a border on the left like a scene edge.
+    Returns the dataset and the water mask"""
+
+    rng = np.random.default_rng(seed)
+
+    # Smoothed noise thresholded at the water fraction gives connected water bodies
+    field = ndimage.gaussian_filter(rng.standard_normal((size, size), dtype=np.float32), sigma=size / 64)
+    water = field < np.quantile(field, water_fraction)
+
+    bands = {}
+    for band in ('VH', 'VV'):
+        values = np.where(water,
+                          rng.normal(*WATER_DB[band], (size, size)),
+                          rng.normal(*LAND_DB[band], (size, size))).astype(np.float32)
+        values[:, :int(size * nodata_fraction)] = np.nan
+        bands[band] = (('time', 'latitude', 'longitude'), values[np.newaxis])
+
+    # Pixel centers on the RES grid, like dc.load returns them
+    top, left = math.ceil(38.0 / RES) * RES, math.floor(23.0 / RES) * RES
+    lat = top - (np.arange(size) + 0.5) * RES
+    lon = left + (np.arange(size) + 0.5) * RES
+    ds = xr.Dataset(bands, coords={'time': [np.datetime64('2021-01-01')], 'latitude': lat, 'longitude': lon})
+
+    return ds, water
+
+class SceneCube:
+    """Stand-in for datacube.Datacube serving one synthetic scene from memory,
+    with the calls predict_product makes (find_datasets and load)"""
+
+    def __init__(self, ds):
+        self.ds = ds
+        self.top = float(ds['latitude'][0]) + RES / 2
+        self.left = float(ds['longitude'][0]) - RES / 2
+        self.height, self.width = ds.sizes['latitude'], ds.sizes['longitude']
+
+    def bounds(self):
+        """min_x, min_y, max_x, max_y of the scene"""
+        return self.left, self.top - self.height * RES, self.left + self.width * RES, self.top
+
+    def find_datasets(self, product, time):
+        """The scene as the only dataset, with the corners get_img_min_max_xy reads"""
+
+        min_x, min_y, max_x, max_y = self.bounds()
+        doc = {'grid_spatial': {'projection': {'geo_ref_points': {'ul': {'x': min_x, 'y': max_y},
+                                                                  'lr': {'x': max_x, 'y': min_y}}}}}
+
+        return [SimpleNamespace(metadata_doc=doc)]
+
+    def load(self, product, time, y, x, resolution, resampling):
+        """Pixels whose centers are inside the y, x bounds, clipped to the scene"""
+
+        r0 = max(round((self.top - y[1]) / RES - 0.5), 0)
+        r1 = max(round((self.top - y[0]) / RES - 0.5) + 1, 0)
+        c0 = max(round((x[0] - self.left) / RES - 0.5), 0)
+        c1 = max(round((x[1] - self.left) / RES - 0.5) + 1, 0)
+
+        return self.ds.isel(latitude=slice(r0, r1), longitude=slice(c0, c1))
+
+def train_model(seed=0, samples=20000):
+    """Small RandomForest trained on synthetic water/land pixels"""
+
+    rng = np.random.default_rng(seed)
+    half = samples // 2
+
+    X = np.concatenate([
+        np.stack([rng.normal(*WATER_DB[b], half) for b in ('VH', 'VV')], axis=1),
+        np.stack([rng.normal(*LAND_DB[b], half) for b in ('VH', 'VV')], axis=1)
+    ]).astype(np.float32)
+    y = np.concatenate([np.ones(half, dtype=np.uint8), np.zeros(half, dtype=np.uint8)])
+
+    clf = RandomForestClassifier(n_estimators=10, max_depth=8, n_jobs=-1, random_state=seed)
+    clf.fit(X, y)
+
+    return clf
+
+def current_rss_mb():
+    """Resident memory (MB) of this process right now"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+def rss_growth_mb(func):
+    """Growth of the resident memory (MB) while func runs, in a forked child whose
+    peak starts at the current memory instead of the largest this process reached"""
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            start = current_rss_mb()
+            func()
+            os.write(write_fd, str(lifetime_peak_rss_mb() - start).encode())
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        growth = f.read()
+    os.waitpid(pid, 0)
+
+    if not growth:
+        raise RuntimeError('Memory run failed')
+
+    return max(float(growth), 0)
+
+def measure(func, repeat, setup=None, memory='traced'):
+    """Best wall time of repeat runs, then the peak memory (MB) of one more run.
+    setup runs before every run, outside of the timing.
+    memory='traced' traces Python and numpy allocations, memory='rss' measures the
+    resident memory growth, which also sees GDAL/rasterio allocations, in a child process.
+    Returns the seconds, the peak and the result of the last timed run"""
+
+    seconds = float('inf')
+    result = None
+    for _ in range(repeat):
+        del result
+        if setup:
+            setup()
+        start = time.perf_counter()
+        result = func()
+        seconds = min(seconds, time.perf_counter() - start)
+
+    if setup:
+        setup()
+
+    if memory == 'rss':
+        peak = rss_growth_mb(func)
+    else:
+        # numpy allocations are traced too
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak /= 1024 * 1024
+
+    return seconds, peak, result
+
+def stage_result(seconds, peak_mb, pixels, memory='traced'):
+    """Seconds, pixels/s and peak MB (and how it was measured) of a stage, rounded for the JSON"""
+    return {'seconds': round(seconds, 4), 'pixels_per_s': round(pixels / seconds), 'peak_mb': round(peak_mb, 1),
+            'memory': memory}
+
+def benchmark_tiles(cube, classifiers, holes_threshold, objects_threshold, memory_budget, workers, repeat, out_dir):
+    """Time the tiled path of predict_product, returns the results per stage"""
+
+    transform, width, height = output_grid(*cube.bounds())
+    pixels = width * height
+    halo = holes_threshold + objects_threshold
+    product = {'id': 'bench', 'title': 'bench', 'beginposition': '2021-01-01T00:00:00.000000Z'}
+    dt = '2021-01-01T00:00:00'
+    results = {}
+
+    for name, clf in classifiers.items():
+        pixel_bytes = bytes_per_pixel(clf)
+        seconds, peak, tiles = measure(lambda: plan_tiles(width, height, memory_budget // workers, halo, pixel_bytes), repeat)
+        results[f'plan_tiles_{name}'] = {**stage_result(seconds, peak, pixels), 'tiles': len(tiles)}
+
+        tile = tiles[0]
+        seconds, peak, _ = measure(lambda: predict_tile(tile, cube, clf, 'bench', dt, transform, halo, width, height,
+                                                        holes_threshold, objects_threshold), repeat)
+        results[f'predict_tile_{name}'] = stage_result(seconds, peak, (tile[1] - tile[0]) * (tile[3] - tile[2]))
+
+        # Load, classify and clean the tiles with their halo, written into the output image as they finish
+        seconds, peak, _ = measure(lambda: predict_product(cube, clf, '', product, 'bench', out_dir, holes_threshold,
+                                                           objects_threshold, memory_budget, workers, halo=halo),
+                                   repeat, memory='rss')
+        results[f'run_tiles_{name}'] = stage_result(seconds, peak, pixels, 'rss')
+
+    # Raw classification of the whole image, kept in a cache folder, for the global cleanup alone
+    raw_cache = os.path.join(out_dir, 'raw')
+    predict_product(cube, clf, '', product, 'bench', out_dir, holes_threshold, objects_threshold,
+                    memory_budget, workers, cleanup='global', raw_cache=raw_cache)
+    raw_path = os.path.join(raw_cache, '2021', '01', 'bench.tif')
+    img_path = os.path.join(out_dir, 'bench_global.tif')
+    global_tiles = plan_tiles(width, height, memory_budget // workers, 0, bytes_per_pixel(clf))
+
+    seconds, peak, _ = measure(lambda: global_cleanup(raw_path, img_path, global_tiles, holes_threshold, objects_threshold),
+                               repeat, memory='rss')
+    results['global_cleanup'] = {**stage_result(seconds, peak, pixels, 'rss'), 'tiles': len(global_tiles)}
+
+    return results
+
+def benchmark_scene(size, classifiers, nodata_fraction, water_fraction, holes_threshold, objects_threshold,
+                    chunks=4, repeat=3, memory_budget=64, workers=2):
+    """Time every stage on one synthetic scene, returns the results per stage"""
+
+    ds, _ = make_scene(size, nodata_fraction, water_fraction)
+    pixels = size * size
+    results = {}
+
+    for name, clf in classifiers.items():
+        seconds, peak, p_w = measure(lambda: predict_water(clf, ds), repeat)
+        results[f'predict_water_{name}'] = stage_result(seconds, peak, pixels)
+
+    seconds, peak, cleaned_w = measure(lambda: clean_water(p_w, holes_threshold, objects_threshold), repeat)
+    results['morphology'] = stage_result(seconds, peak, pixels)
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        results.update(benchmark_tiles(SceneCube(ds), classifiers, holes_threshold, objects_threshold,
+                                       memory_budget, workers, repeat, out_dir))
+
+    # Former chunked path, for comparison only
+
+    lat = ds['latitude'].values
+    lon = ds['longitude'].values
+    rows = np.array_split(np.arange(size), chunks)
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        name = 'bench'
+
+        def write_chunks():
+            for i, chunk in enumerate(rows):
+                create_gt_img(cleaned_w[chunk], lat[chunk], lon, os.path.join(out_dir, f'{name}_{i}'))
+
+        seconds, peak, _ = measure(write_chunks, repeat, memory='rss')
+        results['create_gt_img'] = stage_result(seconds, peak, pixels, 'rss')
+
+        # merge_images removes the chunks it merges, so they are written again before every run
+        seconds, peak, _ = measure(lambda: merge_images(out_dir, name), repeat, setup=write_chunks, memory='rss')
+        results['merge_images'] = stage_result(seconds, peak, pixels, 'rss')
+
+    return results
+
+def find_regressions(results, baseline, tolerance=0.2, min_seconds=0.01):
+    """Stages whose pixels/s dropped or whose peak memory grew by more than tolerance against the baseline.
+    Stages faster than min_seconds in the baseline are within timer noise and only their memory is compared,
+    peaks measured differently (traced or RSS) are not compared"""
+
+    regressions = []
+    for scene, stages in results['scenes'].items():
+        for stage, current in stages.items():
+            previous = baseline.get('scenes', {}).get(scene, {}).get(stage)
+            if not previous:
+                continue
+
+            if previous['seconds'] >= min_seconds and current['pixels_per_s'] < previous['pixels_per_s'] * (1 - tolerance):
+                regressions.append(f"{scene} {stage}: {current['pixels_per_s']:,} pixels/s, baseline {previous['pixels_per_s']:,}")
+            same_memory = current.get('memory', 'traced') == previous.get('memory', 'traced')
+            if same_memory and current['peak_mb'] > previous['peak_mb'] * (1 + tolerance):
+                regressions.append(f"{scene} {stage}: {current['peak_mb']} MB peak, baseline {previous['peak_mb']}")
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the prediction path on synthetic scenes')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 2048, 4096], help='Scene widths (square scenes)')
+    parser.add_argument('--nodata', type=float, default=0.1, help='Fraction of nodata pixels')
+    parser.add_argument('--water', type=float, default=0.2, help='Fraction of water pixels')
+    parser.add_argument('--holes', type=int, default=5, help='[Predict] Holes_Threshold')
+    parser.add_argument('--objects', type=int, default=1, help='[Predict] Objects_Threshold')
+    parser.add_argument('--model', help='joblib model to use instead of a small synthetic RandomForest')
+    parser.add_argument('--lut', action='store_true', help='Also benchmark the lookup table compiled from the model')
+    parser.add_argument('--memory', type=int, default=64, help='[Predict] Memory_Budget (MB) of the tiled path')
+    parser.add_argument('--workers', type=int, default=2, help='[Predict] Workers of the tiled path')
+    parser.add_argument('--chunks', type=int, default=4, help='Chunks written by create_gt_img and merged')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per stage, the fastest is reported')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown/memory growth against the baseline')
+    args = parser.parse_args()
+
+    clf = load(args.model) if args.model else train_model()
+    classifiers = {'model': clf}
+    if args.lut:
+        classifiers['lut'] = compile_lut(clf)
+
+    results = {
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'scenes': {}
+    }
+
+    for size in args.sizes:
+        scene = f'{size}x{size}'
+        print(f'Benchmarking {scene}')
+        results['scenes'][scene] = benchmark_scene(size, classifiers, args.nodata, args.water, args.holes, args.objects,
+                                                   args.chunks, args.repeat, args.memory, args.workers)
+
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+
+        if regressions:
+            print('Regressions against the baseline:')
+            for regression in regressions:
+                print(f'  {regression}')
+            sys.exit(1)
+
+        print('No regressions against the baseline')
@@ -0,0 +1,101 @@
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from rasterio.windows import Window
+
+
+def merge_labels(count, pairs):
+    """Connected components of the label graph whose edges are the (a, b) pairs.
+    Returns the component of every label 0 - count-1"""
+
+    if not len(pairs):
+        return np.arange(count, dtype=np.int64)
+
+    graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])), shape=(count, count))
+    _, components = connected_components(graph, directed=False)
+
+    return components.astype(np.int64)
+
+def border_pairs(labels_a, labels_b):
+    """Unique pairs of labels facing each other across a tile border"""
+
+    both = (labels_a > 0) & (labels_b > 0)
+    if not both.any():
+        return np.empty((0, 2), dtype=np.int64)
+
+    return np.unique(np.stack((labels_a[both], labels_b[both]), axis=1), axis=0)
+
+def label_tile(src, tile, mask_func, offset=0):
+    """Read a tile, label the components of mask_func(block) with 4-connectivity
+    and shift the labels by offset. Returns the block, the labels and their count"""
+
+    r0, r1, c0, c1 = tile
+    block = src.read(1, window=Window(c0, r0, c1 - c0, r1 - r0))
+
+    labels, count = ndimage.label(mask_func(block))
+    labels = labels.astype(np.int64)
+    labels[labels > 0] += offset
+
+    return block, labels, count
+
+def component_areas(src, tiles, mask_func):
+    """First pass: label every tile, merge components across tile borders
+    and sum their global areas.
+    Returns the label offset of every tile, the merged component of every label and the area of every component"""
+
+    offsets = {}
+    areas = [np.zeros(1, dtype=np.int64)]
+    pairs = []
+
+    # Border labels of the tiles already seen, keyed by the position they touch
+    bottom_rows, right_cols = {}, {}
+
+    offset = 0
+    for tile in tiles:
+        r0, r1, c0, c1 = tile
+        _, labels, count = label_tile(src, tile, mask_func, offset)
+        offsets[tile] = offset
+
+        areas.append(np.bincount(labels.ravel(), minlength=offset + count + 1)[offset + 1:])
+
+        # Components continuing from the tile above and on the left
+        if (r0, c0) in bottom_rows:
+            above = bottom_rows.pop((r0, c0))
+            pairs.append(border_pairs(above, labels[0, :len(above)]))
+        if (r0, c0) in right_cols:
+            left = right_cols.pop((r0, c0))
+            pairs.append(border_pairs(left, labels[:len(left), 0]))
+
+        bottom_rows[(r1, c0)] = labels[-1, :].copy()
+        right_cols[(r0, c1)] = labels[:, -1].copy()
+
+        offset += count
+
+    areas = np.concatenate(areas)
+    pairs = np.concatenate(pairs) if pairs else np.empty((0, 2), dtype=np.int64)
+
+    roots = merge_labels(len(areas), pairs)
+    root_areas = np.bincount(roots, weights=areas).astype(np.int64)
+
+    return offsets, roots, root_areas
+
+def remove_small_components(src, dst, tiles, mask_func, threshold, value, nodata=None):
+    """Out-of-core equivalent of skimage's remove_small_objects/remove_small_holes.
+    Components of mask_func(block) smaller than threshold, measured over the whole
+    raster, are set to value in dst. Pixels equal to nodata are never changed.
+    src and dst can be the same dataset opened in r+ mode"""
+
+    offsets, roots, root_areas = component_areas(src, tiles, mask_func)
+
+    # Second pass: label again and replace the small components
+    for tile in tiles:
+        r0, r1, c0, c1 = tile
+        block, labels, _ = label_tile(src, tile, mask_func, offsets[tile])
+
+        small = (labels > 0) & (root_areas[roots[labels]] < threshold)
+        if nodata is not None:
+            small &= block != nodata
+
+        block[small] = value
+        dst.write(block, 1, window=Window(c0, r0, c1 - c0, r1 - r0))
@@ -1,8 +1,27 @@
-from utils import create_connection, read_config
+from utils import create_connection, read_config, backoff_delay
+from metrics import Timings, record_metrics, lifetime_peak_rss_mb
+from product_state import lease_owner, claim, complete, Heartbeat
 import os
 import sqlite3
 import requests
 import hashlib
+import json
+import time
+import threading
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Read buffer when hashing files on disk
+CHUNK_SIZE = 1024 * 1024
+# Streamed download chunks, small so a dropped stream still leaves data in the .part file to resume from
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Quota exceeded, throttled or server errors that are worth retrying
+RETRY_STATUS = (403, 429, 500, 502, 503, 504)
+
+
+class DownloadStopped(Exception):
+    """A download was stopped, its .part file is kept to resume from"""
 
 
 def get_checksum(session, info_link):
@@ -19,107 +38,342 @@ def get_checksum(session, info_link):
     except requests.exceptions.HTTPError as e:
         raise e
 
-def compare_checksums(file_path, checksum):
+def md5_file(file_path):
+    """Returns the MD5 hash object of a file, read with a large buffer"""
+
+    file_hash = hashlib.md5()
+    with open(file_path, "rb", buffering=0) as f:
+        buf = bytearray(CHUNK_SIZE)
+        view = memoryview(buf)
+        n = f.readinto(buf)
+        while n:
+            file_hash.update(view[:n])
+            n = f.readinto(buf)
+
+    return file_hash
+
+def load_verified(cache_path):
+    """Load the cache of files whose checksum has already been verified.
+    Maps a file path to its [size, mtime_ns, checksum]"""
+
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_verified(cache_path, cache):
+    """Atomically write the verified file cache"""
+
+    temp_path = cache_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(dict(cache), f)
+    os.replace(temp_path, cache_path)
+
+def mark_verified(cache, file_path, checksum):
+    """Record a file whose checksum matched, keyed by its size and mtime"""
+
+    if cache is not None:
+        st = os.stat(file_path)
+        cache[file_path] = [st.st_size, st.st_mtime_ns, checksum]
+
+def compare_checksums(file_path, checksum, cache=None):
     """Calculates the MD5 checksum of the downloaded product.
-    Then compares it to the one reported on Scihub to check if the download is valid."""
+    Then compares it to the one reported on Scihub to check if the download is valid.
+    Files found unchanged in the verified cache are not read again."""
 
     if os.path.isfile(file_path):
-        with open(file_path, "rb") as f:
-            file_hash = hashlib.md5()
-            chunk = f.read(8192)
-            while chunk:
-                file_hash.update(chunk)
-                chunk = f.read(8192)
-
-        if file_hash.hexdigest() == checksum:
+        if cache is not None:
+            st = os.stat(file_path)
+            if cache.get(file_path) == [st.st_size, st.st_mtime_ns, checksum]:
+                return True
+
+        if md5_file(file_path).hexdigest() == checksum:
+            mark_verified(cache, file_path, checksum)
             return True
 
     return False
 
-def download_product(session, filename, dl_link, dl_path, checksum):
-    """Download product and compare checksum for verification"""
+def read_part_info(info_path):
+    """Read the sidecar of a partial download.
+    Returns an empty dict if it does not exist or is unreadable"""
+
+    try:
+        with open(info_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_part_info(info_path, size, checksum):
+    """Record the expected size and checksum of a partial download"""
+
+    with open(info_path, 'w') as f:
+        json.dump({'size': size, 'checksum': checksum}, f)
+
+def remove_partial(part_path, info_path):
+    """Delete a partial download and its sidecar"""
+
+    for path in (part_path, info_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+def download_product(session, filename, dl_link, dl_path, checksum, retries=5, backoff=2, backoff_max=300, cache=None, timings=None, stop=None):
+    """Download product and compare checksum for verification.
+    Data is written to a .part file which is resumed with an HTTP Range request
+    after an interruption. Retryable errors back off with jitter.
+    The MD5 is computed while the chunks arrive, so the file is not read back.
+    The bytes received and the retries are added to timings.
+    Raises DownloadStopped between chunks or attempts once the stop event is set"""
+
+    if timings is None:
+        timings = Timings()
 
     filename = filename + '.zip'
     
     file_path = os.path.join(dl_path, filename)
+    part_path = file_path + '.part'
+    info_path = part_path + '.json'
 
     # Check if product has already been downloaded
-    if compare_checksums(file_path, checksum):
+    if compare_checksums(file_path, checksum, cache):
         print(f'{filename} already downloaded')
         return True
 
+    # Partial data of an older version of the product can't be resumed
+    part_info = read_part_info(info_path)
+    if part_info.get('checksum') != checksum:
+        remove_partial(part_path, info_path)
+        part_info = {}
+
+    # Running hash of the partial file and the number of bytes it covers
+    file_hash, hashed = None, 0
+
     print(f'Downloading {filename}')
-    # Download product
-    with session.get(dl_link, stream=True) as r:
-        print("Status: ", r.status_code, dl_link)
+    for attempt in range(retries + 1):
+        if attempt:
+            delay = backoff_delay(attempt - 1, backoff, backoff_max)
+            print(f'Retrying {filename} in {delay:.1f}s ({attempt}/{retries})')
+            timings.add('retries', 1)
+            if stop is None:
+                time.sleep(delay)
+            elif stop.wait(delay):
+                raise DownloadStopped(filename)
 
-        if r.status_code == 403:
-            print('Returned 403')
-            raise KeyboardInterrupt
+        if stop is not None and stop.is_set():
+            raise DownloadStopped(filename)
 
-        if r.status_code != 500 or r.status_code != 202:
-            with open(file_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192): 
-                    f.write(chunk)
-        else:
-            return False
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+
+        # Partial file already has every byte
+        if offset and offset == part_info.get('size'):
+            break
+
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+        try:
+            # Download product
+            with session.get(dl_link, stream=True, headers=headers, timeout=60) as r:
+                print("Status: ", r.status_code, dl_link)
+
+                # Product is offline (Long Term Archive), try again at next run
+                if r.status_code == 202:
+                    return False
+
+                # Range is past the end of the file, verify what we have
+                if r.status_code == 416:
+                    break
+
+                # Quota exceeded, throttled or server errors
+                if r.status_code in RETRY_STATUS:
+                    continue
+
+                r.raise_for_status()
+
+                # Server ignored the Range header, start over
+                if r.status_code == 200:
+                    offset = 0
+                    size = int(r.headers.get('Content-Length', 0)) or None
+                else:
+                    size = int(r.headers.get('Content-Range', '*/0').split('/')[-1] or 0) or None
+
+                part_info = {'size': size, 'checksum': checksum}
+                write_part_info(info_path, size, checksum)
 
+                # Keep the running hash if it covers the partial file,
+                # otherwise hash what is already on disk once
+                if file_hash is None or hashed != offset:
+                    file_hash = md5_file(part_path) if offset else hashlib.md5()
+                    hashed = offset
 
-    # Check if product downloaded correctly
-    if compare_checksums(file_path, checksum):
+                with open(part_path, 'ab' if offset else 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                        if stop is not None and stop.is_set():
+                            raise DownloadStopped(filename)
+                        f.write(chunk)
+                        file_hash.update(chunk)
+                        hashed += len(chunk)
+                        timings.add('bytes', len(chunk))
+            break
+
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as e:
+            print(f'Download of {filename} interrupted: {e}')
+    else:
+        print(f'Giving up on {filename} after {retries} retries')
+        return False
+
+    if not os.path.isfile(part_path):
+        return False
+
+    # Check if product downloaded correctly.
+    # Only hash the file if the stream did not cover all of it
+    if file_hash is None or hashed != os.path.getsize(part_path):
+        file_hash = md5_file(part_path)
+
+    if file_hash.hexdigest() == checksum:
+        os.replace(part_path, file_path)
+        remove_partial(part_path, info_path)
+        mark_verified(cache, file_path, checksum)
         print('Downloaded Correctly.')
         return True
 
     # If product failed to be downloaded correctly
+    remove_partial(part_path, info_path)
     return False
 
 
+def create_session(config, connections_per_host=1):
+    """Create a Scihub session.
+    The connection pool blocks when more than connections_per_host connections are open to one host"""
+
+    session = requests.Session()
+    session.auth = (config['Scihub']['Username'], config['Scihub']['Password'])
+    session.headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36'}
+
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections_per_host, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+def fetch_product(session, product, dl_path, retries=5, backoff=2, cache=None, timings=None, stop=None):
+    """Get the checksum (if missing) and download a single product.
+    Returns the checksum and whether the download succeeded. DB updates are left to the caller.
+    Seconds, bytes and MB/s are recorded in timings. Raises DownloadStopped once stop is set"""
+
+    if timings is None:
+        timings = Timings()
+
+    checksum = product['checksum']
+    # Get checksum if it doesn't exist
+    if not checksum:
+        checksum = get_checksum(session, product['info_link'])
+
+    # Download product
+    with timings.time('seconds'):
+        downloaded = download_product(session, product['title'], product['dl_link'], dl_path, checksum, retries, backoff, cache=cache, timings=timings, stop=stop)
+
+    seconds = timings.values['seconds']
+    timings.set('mb_per_s', timings.values.get('bytes', 0) / 1024 / 1024 / seconds if seconds else 0)
+
+    if downloaded:
+        return checksum, True
+
+    # Check if checksum has been changed on scihub
+    checksum = get_checksum(session, product['info_link'])
+
+    return checksum, False
+
+def finish_download(con, product, owner, timings, future, retry_delay):
+    """Record the result of a finished download and release its lease"""
+
+    cur = con.cursor()
+    try:
+        checksum, downloaded = future.result()
+    except DownloadStopped:
+        # Resumed from its .part file by the next run
+        with con:
+            complete(cur, product['id'], owner, {})
+        return
+    except Exception as e:
+        # A failed product should not stop the rest of the batch
+        print(f"Failed to download {product['title']}: {e}")
+        with con:
+            complete(cur, product['id'], owner, {}, retry_delay)
+        return
+
+    with con:
+        complete(cur, product['id'], owner, {'checksum': checksum, 'downloaded': int(downloaded)},
+                 None if downloaded else retry_delay)
+        record_metrics(cur, product['id'], 'download', {**timings.values, 'lifetime_peak_rss_mb': lifetime_peak_rss_mb()})
+
+
 if __name__ == '__main__':
 
     # Load config
     config = read_config('config.ini')
 
     dl_path = config['Path']['Download']
+    workers = config.getint('Download', 'Workers', fallback=1)
+    connections_per_host = config.getint('Download', 'Connections_Per_Host', fallback=workers)
+    retries = config.getint('Download', 'Retries', fallback=5)
+    backoff = config.getfloat('Download', 'Backoff', fallback=2)
+    min_coverage = config.getfloat('Preprocess', 'Min_Coverage', fallback=0)
+    cache_path = config.get('Download', 'Verified_Cache', fallback='') or os.path.join(dl_path, '.verified.json')
+
+    # Files already verified on previous runs
+    cache = load_verified(cache_path)
+
+    lease_seconds = config.getfloat('Database', 'Lease_Seconds', fallback=300)
+    retry_delay = config.getfloat('Database', 'Retry_Delay', fallback=600)
 
     # Create SQLite connection
     con = create_connection(config['Path']['Database'])
     con.row_factory = sqlite3.Row
     cur = con.cursor()
 
-    # Get not downloaded products
-    products_down = cur.execute('SELECT * FROM s1_products WHERE downloaded=0 ORDER BY beginposition DESC')
-    products_down = [dict(row) for row in cur.fetchall()]
+    # Lease the products waiting for download, so orchestrators and other runs skip them
+    owner = lease_owner()
+    products_down = claim(con, 'download', owner, lease_seconds, None, min_coverage)
 
     # Create session
-    session = requests.Session()
-    session.auth = (config['Scihub']['Username'], config['Scihub']['Password'])
-    session.headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36'}
-    
+    session = create_session(config, connections_per_host)
+
     try: 
         if len(products_down) != 0:
-            for product in products_down:
-
-                checksum = product['checksum']
-                # Get checksum if it doesn't exist
-                if not checksum:
-                    checksum = get_checksum(session, product['info_link'])
+            # Workers only download, all DB updates happen on this thread
+            # as each product finishes
+            executor = ThreadPoolExecutor(max_workers=workers)
+            stop = threading.Event()
+            futures = {}
+            with Heartbeat(config['Path']['Database'], owner, [product['id'] for product in products_down], lease_seconds):
+                try:
+                    for product in products_down:
+                        timings = Timings()
+                        futures[executor.submit(fetch_product, session, product, dl_path, retries, backoff, cache, timings, stop)] = (product, timings)
 
-                    cur.execute('UPDATE s1_products SET checksum = ? WHERE id = ?', (checksum, product['id']))
-                    con.commit()
-
-                # Download product
-                if download_product(session, product['title'], product['dl_link'], dl_path, checksum):
-                    cur.execute('UPDATE s1_products SET downloaded = 1 WHERE id = ?', (product['id'],))
-                    con.commit()
-                # Check if checksum has been changed on scihub
-                else:
-                    checksum = get_checksum(session, product['info_link'])
+                    for future in as_completed(futures):
+                        product, timings = futures.pop(future)
+                        finish_download(con, product, owner, timings, future, retry_delay)
+                        save_verified(cache_path, cache)
+                finally:
+                    # On Ctrl-C or an error the queued downloads are cancelled and the running ones
+                    # stop at their next chunk or retry, keeping their .part file
+                    stop.set()
+                    executor.shutdown(wait=True, cancel_futures=True)
 
-                    cur.execute('UPDATE s1_products SET checksum = ? WHERE id = ?', (checksum, product['id']))
-                    con.commit()
+                    # Record what finished meanwhile, the leases of the rest are freed
+                    for future, (product, timings) in futures.items():
+                        if future.cancelled():
+                            with con:
+                                complete(cur, product['id'], owner, {})
+                        else:
+                            finish_download(con, product, owner, timings, future, retry_delay)
+                    save_verified(cache_path, cache)
         else:
             print('No products to download')
     except KeyboardInterrupt:
         print('Exiting...')
     finally:
-        con.close()
\ No newline at end of file
+        con.close()
@@ -1,57 +1,115 @@
-from utils import create_connection, read_config, build_preprocessed_path
+from utils import create_connection, read_config, build_preprocessed_path, daemon_pid_path, notify_daemon
+from metrics import record_metrics, lifetime_peak_rss_mb
+from product_state import lease_owner, claim, complete, release, Heartbeat
 import os, sys
-import subprocess
+import time
 import sqlite3
+from pathlib import Path
+import datacube
+from datacube.index.hl import Doc2Dataset
+from datacube.utils import documents
+
+
+def index_dataset(dc, resolver, yml_file):
+    """Add every dataset document of a .yml index file to the datacube.
+    Raises a RuntimeError if a document can't be resolved"""
+
+    uri = Path(yml_file).absolute().as_uri()
+
+    for _, doc in documents.read_documents(yml_file):
+        dataset, err = resolver(doc, uri)
+
+        if err:
+            raise RuntimeError(err)
+
+        dc.index.datasets.add(dataset)
+
+def index_product(dc, resolver, product, prep_path):
+    """Index the .yml of a preprocessed product.
+    Returns False if the product has no index file"""
+
+    outdir_path = build_preprocessed_path(product, prep_path)
+
+    try:
+        # Get full path to .yml index file
+        yml_file = os.path.join(outdir_path, [f for f in os.listdir(outdir_path) if f.endswith('.yml')][0])
+    except (IndexError, FileNotFoundError):
+        return False
+
+    index_dataset(dc, resolver, yml_file)
+
+    return True
 
 
 if __name__ == '__main__':
     config = read_config('config.ini')
-    
+
     prep_path = config['Path']['Preprocess']
-    venv_path = config['Path']['Venv']
     product_file_name = config['Preprocess']['Product_Name']
 
+    lease_seconds = config.getfloat('Database', 'Lease_Seconds', fallback=300)
+    retry_delay = config.getfloat('Database', 'Retry_Delay', fallback=600)
 
     # Create SQLite connection
     con = create_connection(config['Path']['Database'])
     con.row_factory = sqlite3.Row
     cur = con.cursor()
 
-    # Get preprocessed but not indexed products
-    products_down = cur.execute('SELECT * FROM s1_products WHERE preprocessed=1 AND indexed=0 ORDER BY beginposition DESC')
-    products_down = [dict(row) for row in cur.fetchall()]
+    # Preprocessed but not indexed products are leased one at a time,
+    # so orchestrators and other runs never index the same product
+    owner = lease_owner()
+    products = claim(con, 'index', owner, lease_seconds)
+
+    # Number of products indexed
+    indexed = 0
+    dc = None
 
     try:
-        if len(products_down) != 0:
-            for product in products_down:
+        if products:
+            # One datacube connection for the whole batch
+            dc = datacube.Datacube(app="index_preprocessed")
+            resolver = Doc2Dataset(dc.index, products=[product_file_name])
+
+            while products:
+                product = products[0]
                 product_name = product['title']
                 print(f'Indexing: {product_name}')
 
-                outdir_path = build_preprocessed_path(product, prep_path)
-
+                # Index file
+                start = time.perf_counter()
                 try:
-                    # Get full path to .yml index file
-                    yml_file = os.path.join(outdir_path, [f for f in os.listdir(outdir_path) if f.endswith('.yml')][0])
-                                    
-                except IndexError:
-                    print('No index file found (yml). Will try to preprocess again at next run.')
-                    
-                    # Update DB
-                    cur.execute('UPDATE s1_products SET preprocessed = 0 WHERE id = ?', (product['id'],))
-                    con.commit()
+                    with Heartbeat(config['Path']['Database'], owner, [product['id']], lease_seconds):
+                        found = index_product(dc, resolver, product, prep_path)
+                except Exception as e:
+                    print(f'Failed to index {product_name}: {e}')
+                    with con:
+                        complete(cur, product['id'], owner, {}, retry_delay)
+                    products = claim(con, 'index', owner, lease_seconds)
                     continue
 
-                # Index file
-                subprocess.call(f"{venv_path}bin/datacube dataset add {yml_file} -p {product_file_name}", shell=True)
-                
-                # Update DB
-                cur.execute('UPDATE s1_products SET indexed = 1 WHERE id = ?', (product['id'],))
-                con.commit()
+                # Update DB only for the datasets that succeeded
+                with con:
+                    if not found:
+                        print('No index file found (yml). Will try to preprocess again at next run.')
+                        complete(cur, product['id'], owner, {'preprocessed': 0})
+                    elif complete(cur, product['id'], owner, {'indexed': 1}):
+                        record_metrics(cur, product['id'], 'index', {'seconds': time.perf_counter() - start, 'lifetime_peak_rss_mb': lifetime_peak_rss_mb()})
+                        indexed += 1
+                        print(f'Indexed: {product_name}')
 
-                print(f'Indexed: {product_name}')
+                products = claim(con, 'index', owner, lease_seconds)
+
+            print(f'Indexed {indexed} products')
         else:
             print('No products to ingest')
     except KeyboardInterrupt:
             print('Exiting...')
     finally:
-        con.close()
\ No newline at end of file
+        if dc is not None:
+            dc.close()
+        release(con, owner)
+        con.close()
+
+        # New products for the prediction daemon
+        if indexed:
+            notify_daemon(daemon_pid_path(config))
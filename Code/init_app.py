@@ -1,9 +1,76 @@
-from utils import read_config
+from utils import read_config, shapefile_fingerprint, dem_cache_valid
+from product_state import status_schema, backfill_status
+from metrics import METRICS_SCHEMA
 from pathlib import Path
-from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String
+import json
+import math
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, Float, Index, inspect, text
 import fiona
 from shapely.geometry import shape
 import subprocess
+from osgeo import gdal, osr
+
+
+def egm96_applied(lon=23.7, lat=38.0):
+    """Check that PROJ (as GDAL uses it) shifts EGM96 heights to ellipsoid heights at a known point.
+    Without the egm96 grid it falls back to a ballpark transformation that leaves heights unchanged"""
+
+    src = osr.SpatialReference()
+    src.SetFromUserInput('EPSG:4326+5773')
+    dst = osr.SpatialReference()
+    dst.ImportFromEPSG(4979)
+    for srs in (src, dst):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    try:
+        _, _, height = osr.CoordinateTransformation(src, dst).TransformPoint(lon, lat, 0)
+    except RuntimeError:
+        return False
+
+    # The geoid is tens of meters off the ellipsoid around the AOI, a failed transformation gives inf
+    return math.isfinite(height) and abs(height) > 1
+
+def build_dem_cache(shp_path, tiles_path, dem_path, margin=0.1, apply_egm=True):
+    """Mosaic the local DEM tiles covering the AOI (plus a margin) into one GeoTIFF.
+    With apply_egm the EGM96 geoid heights are converted to ellipsoid heights,
+    so SNAP doesn't have to apply it on every run"""
+
+    tiles = [str(p) for p in Path(tiles_path).iterdir() if p.suffix.lower() in ('.hgt', '.tif', '.tiff')]
+    if not tiles:
+        print('No DEM tiles found in {}'.format(tiles_path))
+        return False
+
+    # SNAP is told not to apply EGM96 to the cached DEM, so a skipped shift would
+    # silently put terrain correction tens of meters off
+    if apply_egm and not egm96_applied():
+        raise RuntimeError('PROJ cannot apply EGM96 (is the us_nga_egm96_15.tif grid installed? '
+                           'run projsync --file us_nga_egm96_15.tif or set PROJ_NETWORK=ON)')
+
+    with fiona.open(shp_path) as c:
+        minx, miny, maxx, maxy = c.bounds
+
+    vrt_path = '/vsimem/dem_mosaic.vrt'
+    gdal.BuildVRT(vrt_path, tiles)
+
+    ds = gdal.Warp(dem_path, vrt_path,
+                outputBounds = (minx - margin, miny - margin, maxx + margin, maxy + margin),
+                srcSRS = 'EPSG:4326+5773' if apply_egm else None,
+                dstSRS = 'EPSG:4979' if apply_egm else None,
+                srcNodata = -32768, dstNodata = -32768,
+                resampleAlg = 'bilinear',
+                outputType = gdal.GDT_Float32,
+                format = 'GTiff',
+                creationOptions = ['TILED=YES', 'COMPRESS=DEFLATE', 'PREDICTOR=3', 'BIGTIFF=IF_SAFER'],
+                multithread=True)
+    ds = None
+    gdal.Unlink(vrt_path)
+
+    # Record which AOI the DEM was built for
+    with open(dem_path + '.json', 'w') as f:
+        json.dump({'aoi': shapefile_fingerprint(shp_path), 'egm_applied': apply_egm}, f)
+
+    print('AOI DEM created: {}'.format(dem_path))
+    return True
 
 if __name__ == '__main__':
 
@@ -32,11 +99,53 @@ if __name__ == '__main__':
             Column('preprocessed', Integer),
             Column('indexed', Integer),
             Column('detected', Integer),
+            Column('coverage', Float),
+            Column('classifier_fp', String),
+            Column('result_fp', String),
+            Column('status', String),
+            Column('lease_owner', String),
+            Column('lease_expires', Float),
+            Index('ix_{}_coverage'.format(config['Database']['Table']), 'coverage'),
             sqlite_with_rowid=False
         )
 
         meta.create_all(engine)
 
+        # Status index and the triggers keeping it up to date
+        with engine.begin() as conn:
+            for statement in status_schema(config['Database']['Table']):
+                conn.execute(text(statement))
+    else:
+        # Add columns to databases created before they existed
+        engine = create_engine('{}:///{}'.format(config['Database']['Engine'], config['Path']['Database']))
+        table_name = config['Database']['Table']
+
+        new_columns = {'coverage': 'REAL', 'classifier_fp': 'VARCHAR', 'result_fp': 'VARCHAR',
+                       'status': 'VARCHAR', 'lease_owner': 'VARCHAR', 'lease_expires': 'REAL'}
+
+        columns = [col['name'] for col in inspect(engine).get_columns(table_name)]
+        with engine.begin() as conn:
+            for column, col_type in new_columns.items():
+                if column not in columns:
+                    conn.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(table_name, column, col_type)))
+            conn.execute(text('CREATE INDEX IF NOT EXISTS ix_{0}_coverage ON {0} (coverage)'.format(table_name)))
+
+            for statement in status_schema(table_name):
+                conn.execute(text(statement))
+            conn.execute(text(backfill_status(table_name)))
+
+    # Per product stage metrics
+    with engine.begin() as conn:
+        conn.execute(text(METRICS_SCHEMA))
+
+    # The journal mode is stored in the database file, connections of the stages don't set it.
+    # Switching fails while another connection is open
+    journal_mode = config['Database'].get('Journal_Mode', 'WAL')
+    with engine.connect() as conn:
+        mode = conn.execute(text('PRAGMA journal_mode={}'.format(journal_mode))).scalar()
+    if mode.lower() != journal_mode.lower():
+        print(f'Journal mode is still {mode}, stop every stage and run init_app.py again to switch to {journal_mode}')
+
 
     # Create folders
     app_folders = [
@@ -61,6 +170,12 @@ if __name__ == '__main__':
         file_api = "{}_api.txt".format(config['Preprocess']['SHP'][:-4])
         with open(file_api, 'w') as smpl_fl:
             smpl_fl.write(polygon_simplified)
+
+        # Build the AOI DEM once, rebuilt only when the AOI changes
+        dem_path = config['Preprocess'].get('DEM_File')
+        dem_tiles = config['Preprocess'].get('DEM_Tiles')
+        if dem_path and dem_tiles and not dem_cache_valid(dem_path, config['Preprocess']['SHP']):
+            build_dem_cache(config['Preprocess']['SHP'], dem_tiles, dem_path)
     else:
         print('File {} does not exist.'.format(config['Preprocess']['SHP']))
 
@@ -0,0 +1,145 @@
+from utils import read_config, create_connection
+import sys
+import time
+import resource
+import sqlite3
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Latest value of every metric of every product stage, run level metrics (sync) have product_id ''
+METRICS_SCHEMA = '''CREATE TABLE IF NOT EXISTS product_metrics (
+    product_id VARCHAR, stage VARCHAR, name VARCHAR, value REAL, recorded_at REAL,
+    PRIMARY KEY (product_id, stage, name)) WITHOUT ROWID'''
+
+
+class Timings:
+    """Thread-safe sums of seconds and counts measured during one stage of a product"""
+
+    def __init__(self):
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, value):
+        """Add value to name"""
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def set(self, name, value):
+        """Replace the value of name"""
+        with self._lock:
+            self.values[name] = value
+
+    def peak(self, name, value):
+        """Keep the largest value of name"""
+        with self._lock:
+            self.values[name] = max(self.values.get(name, 0), value)
+
+    @contextmanager
+    def time(self, name):
+        """Add the seconds spent in the with block to name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+
+def lifetime_peak_rss_mb(children=False):
+    """Peak resident memory (MB) over the lifetime of this process, or of the largest of its finished
+    child processes (e.g. SNAP gpt). Maxima since the process started, not of the current product"""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+
+    # Linux reports KB
+    return usage.ru_maxrss / 1024
+
+def record_metrics(cur, product_id, stage, values):
+    """Store the metrics of a product stage, replacing those of a previous run"""
+
+    now = time.time()
+    cur.executemany('INSERT OR REPLACE INTO product_metrics (product_id, stage, name, value, recorded_at) VALUES (?, ?, ?, ?, ?)',
+                    [(product_id or '', stage, name, float(value), now) for name, value in values.items()])
+
+def prometheus_text(con, table='s1_products'):
+    """Products per status and per stage metric aggregates in the Prometheus text format"""
+
+    lines = ['# HELP s1_products Products per pipeline status', '# TYPE s1_products gauge']
+    for status, count in con.execute('SELECT status, COUNT(*) FROM {} GROUP BY status'.format(table)):
+        lines.append(f's1_products{{status="{status}"}} {count}')
+
+    rows = con.execute('''SELECT m.stage, m.name, SUM(m.value), COUNT(*), MAX(m.value),
+        (SELECT l.value FROM product_metrics l WHERE l.stage = m.stage AND l.name = m.name ORDER BY l.recorded_at DESC LIMIT 1)
+        FROM product_metrics m GROUP BY m.stage, m.name''').fetchall()
+
+    families = [
+        ('s1_stage_metric_sum', 'gauge', 'Sum over products of a stage metric', 2),
+        ('s1_stage_metric_count', 'gauge', 'Products that recorded a stage metric', 3),
+        ('s1_stage_metric_max', 'gauge', 'Largest value of a stage metric', 4),
+        ('s1_stage_metric_last', 'gauge', 'Most recent value of a stage metric', 5),
+    ]
+    for family, kind, help_text, column in families:
+        lines += [f'# HELP {family} {help_text}', f'# TYPE {family} {kind}']
+        for row in rows:
+            lines.append(f'{family}{{stage="{row[0]}",name="{row[1]}"}} {row[column]}')
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    db_path = None
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        con = create_connection(self.db_path)
+        try:
+            body = prometheus_text(con).encode()
+        except sqlite3.Error as e:
+            self.send_error(500, str(e))
+            return
+        finally:
+            con.close()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(db_path, port, host='127.0.0.1'):
+    """Serve /metrics from the database on a background thread. Returns the server"""
+
+    handler = type('Handler', (MetricsHandler,), {'db_path': db_path})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+if __name__ == '__main__':
+    # python metrics.py         serve /metrics on [Metrics] Port
+    # python metrics.py print   print the metrics once
+    config = read_config('config.ini')
+    db_path = config['Path']['Database']
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'print':
+        con = create_connection(db_path)
+        print(prometheus_text(con), end='')
+        con.close()
+        sys.exit()
+
+    port = int(config['Metrics'].get('Port') or 9108)
+    server = start_metrics_server(db_path, port, config.get('Metrics', 'Host', fallback='127.0.0.1'))
+    print(f'Serving http://{server.server_address[0]}:{port}/metrics')
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
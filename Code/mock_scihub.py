@@ -0,0 +1,276 @@
+"""Offline stand-in for the Scihub OpenSearch and OData endpoints.
+
+Serves the OpenSearch JSON parsed by sync_s1_products.get_page, the OData
+checksum read by download_products.get_checksum and synthetic zip payloads
+with HTTP Range support. Latency, bandwidth and error rates are configurable
+so sync and download changes can be measured without the real endpoint.
+"""
+import argparse
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+import uuid
+import zipfile
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+
+# Default footprint, a box around Attica
+FOOTPRINT = 'POLYGON ((22.5 37.5, 24.5 37.5, 24.5 38.5, 22.5 38.5, 22.5 37.5))'
+
+
+def make_products(count, footprint=FOOTPRINT, start=datetime(2021, 3, 30)):
+    """Create the metadata of count synthetic products, newest first"""
+
+    products = []
+    for i in range(count):
+        begin = start - timedelta(hours=12 * i)
+        end = begin + timedelta(seconds=25)
+        stamp_b, stamp_e = begin.strftime('%Y%m%dT%H%M%S'), end.strftime('%Y%m%dT%H%M%S')
+
+        title = f'S1A_IW_GRDH_1SDV_{stamp_b}_{stamp_e}_0{i:05d}_000000_{i:04X}'
+        products.append({
+            'uuid': str(uuid.uuid5(uuid.NAMESPACE_URL, title)),
+            'identifier': title,
+            'filename': title + '.SAFE',
+            'beginposition': begin.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'endposition': end.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'orbitnumber': 30000 + i,
+            'orbitdirection': 'ASCENDING' if i % 2 else 'DESCENDING',
+            'footprint': footprint,
+        })
+
+    return products
+
+def make_payload(title, size):
+    """Synthetic zip of roughly size bytes.
+    Stored uncompressed so the payload size is predictable"""
+
+    rnd = random.Random(title)
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as zf:
+        zf.writestr(f'{title}.SAFE/measurement/data.bin', rnd.randbytes(size))
+
+    return buf.getvalue()
+
+
+class MockScihub:
+    """State shared by the request handlers: products, payloads, settings and counters"""
+
+    def __init__(self, count=20, payload_size=2 * 1024 * 1024, latency=0.0, bandwidth=0,
+                 error_rate=0.0, drop_rate=0.0, seed=0):
+        self.products = make_products(count)
+        self.by_uuid = {prd['uuid']: prd for prd in self.products}
+        self.payload_size = payload_size
+        self.latency = latency
+        # Bytes per second per connection, 0 for unlimited
+        self.bandwidth = bandwidth
+        # Probability of a 503 reply and of a connection dropped mid-payload
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.payloads = {}
+        self.stats = {'requests': 0, 'errors': 0, 'drops': 0, 'range_requests': 0, 'bytes_sent': 0}
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def roll(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def payload(self, prd_uuid):
+        with self.lock:
+            if prd_uuid not in self.payloads:
+                title = self.by_uuid[prd_uuid]['identifier']
+                data = make_payload(title, self.payload_size)
+                self.payloads[prd_uuid] = (data, hashlib.md5(data).hexdigest())
+
+            return self.payloads[prd_uuid]
+
+    def entry(self, base_url, prd):
+        """OpenSearch entry in the layout Scihub returns"""
+
+        odata = f"{base_url}odata/v1/Products('{prd['uuid']}')"
+        return {
+            'title': prd['identifier'],
+            'link': [{'href': odata + '/$value'}, {'rel': 'alternative', 'href': odata + '/'}],
+            'id': prd['uuid'],
+            'date': [{'name': 'beginposition', 'content': prd['beginposition']},
+                     {'name': 'endposition', 'content': prd['endposition']}],
+            'int': [{'name': 'orbitnumber', 'content': str(prd['orbitnumber'])}],
+            'str': [{'name': 'uuid', 'content': prd['uuid']},
+                    {'name': 'identifier', 'content': prd['identifier']},
+                    {'name': 'filename', 'content': prd['filename']},
+                    {'name': 'orbitdirection', 'content': prd['orbitdirection']},
+                    {'name': 'footprint', 'content': prd['footprint']}],
+        }
+
+    def search(self, base_url, query):
+        """One page of OpenSearch results"""
+
+        start = int(query.get('start', ['0'])[0])
+        rows = int(query.get('rows', ['100'])[0])
+        page = self.products[start:start + rows]
+
+        feed = {
+            'opensearch:totalResults': str(len(self.products)),
+            'opensearch:startIndex': str(start),
+            'opensearch:itemsPerPage': str(rows),
+            'link': [{'rel': 'self', 'href': f'{base_url}search?start={start}&rows={rows}'}],
+        }
+        if start + rows < len(self.products):
+            feed['link'].append({'rel': 'next', 'href': f'{base_url}search?start={start + rows}&rows={rows}&format=json'})
+
+        if page:
+            entries = [self.entry(base_url, prd) for prd in page]
+            feed['entry'] = entries[0] if len(entries) == 1 else entries
+
+        return {'feed': feed}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def mock(self):
+        return self.server.mock
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_reply(self, status):
+        self.mock.count('errors')
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        mock = self.mock
+        mock.count('requests')
+
+        if mock.latency:
+            time.sleep(mock.latency)
+
+        url = urlparse(self.path)
+        path = unquote(url.path)
+        base_url = f'http://{self.headers["Host"]}/'
+
+        if path == '/stats':
+            return self.send_json(mock.stats)
+
+        if mock.roll(mock.error_rate):
+            return self.send_error_reply(503)
+
+        if path == '/search':
+            return self.send_json(mock.search(base_url, parse_qs(url.query)))
+
+        if path.startswith("/odata/v1/Products('"):
+            prd_uuid = path.split("'")[1]
+            if prd_uuid not in mock.by_uuid:
+                return self.send_error_reply(404)
+
+            if path.endswith('/$value'):
+                return self.send_payload(prd_uuid)
+
+            checksum = mock.payload(prd_uuid)[1]
+            return self.send_json({'d': {'Id': prd_uuid, 'Checksum': {'Algorithm': 'MD5', 'Value': checksum}}})
+
+        self.send_error_reply(404)
+
+    def send_payload(self, prd_uuid):
+        mock = self.mock
+        data = mock.payload(prd_uuid)[0]
+        start, end = 0, len(data) - 1
+
+        range_header = self.headers.get('Range')
+        if range_header:
+            mock.count('range_requests')
+            first, _, last = range_header.split('=')[1].partition('-')
+            start = int(first)
+            end = int(last) if last else end
+
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(data)}')
+                self.send_header('Content-Length', '0')
+                return self.end_headers()
+
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        # Drop the connection somewhere in the middle of the payload
+        drop_at = end + 1
+        if mock.roll(mock.drop_rate):
+            drop_at = random.randint(start, end)
+            mock.count('drops')
+
+        chunk = 64 * 1024
+        pos = start
+        while pos <= end:
+            if pos >= drop_at:
+                self.close_connection = True
+                return
+
+            block = data[pos:min(pos + chunk, end + 1, drop_at)]
+            self.wfile.write(block)
+            mock.count('bytes_sent', len(block))
+            pos += len(block)
+
+            if mock.bandwidth:
+                time.sleep(len(block) / mock.bandwidth)
+
+
+def start_server(mock, host='127.0.0.1', port=0):
+    """Serve mock on a background thread. Returns the server, use server.server_port for the port"""
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.mock = mock
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline Scihub stand-in')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--products', type=int, default=20)
+    parser.add_argument('--payload-mb', type=float, default=2)
+    parser.add_argument('--latency', type=float, default=0, help='Seconds added to every request')
+    parser.add_argument('--bandwidth-mb', type=float, default=0, help='MB/s per connection, 0 for unlimited')
+    parser.add_argument('--error-rate', type=float, default=0, help='Probability of a 503 reply')
+    parser.add_argument('--drop-rate', type=float, default=0, help='Probability of a dropped payload connection')
+    args = parser.parse_args()
+
+    mock = MockScihub(args.products, int(args.payload_mb * 1024 * 1024), args.latency,
+                      int(args.bandwidth_mb * 1024 * 1024), args.error_rate, args.drop_rate)
+    server = start_server(mock, port=args.port)
+
+    print(f'Mock Scihub at http://127.0.0.1:{server.server_port}/')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        print('Exiting...')
+        server.shutdown()
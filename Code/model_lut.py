@@ -0,0 +1,108 @@
+from utils import read_config, file_fingerprint
+import numpy as np
+
+
+def split_range(model, feature, margin=1.0):
+    """Range of a feature covering every split threshold of a tree ensemble.
+    Outside of it the model output is constant, so clipping to it is exact.
+    Returns None if the thresholds can't be read (e.g. a Pipeline)"""
+
+    thresholds = []
+    for tree in getattr(model, 'estimators_', []):
+        tree = tree.tree_
+        thresholds.extend(tree.threshold[tree.feature == feature])
+
+    if not thresholds:
+        return None
+
+    return min(thresholds) - margin, max(thresholds) + margin
+
+def compile_lut(model, step=0.05, vh_range=(-50, 10), vv_range=(-50, 10), batch=1_000_000):
+    """Evaluate the model once on a quantized (VH, VV) grid.
+    Returns the lookup table as a dict of arrays"""
+
+    vh_range = split_range(model, 0) or vh_range
+    vv_range = split_range(model, 1) or vv_range
+
+    vh_axis = np.arange(vh_range[0], vh_range[1] + step, step, dtype=np.float32)
+    vv_axis = np.arange(vv_range[0], vv_range[1] + step, step, dtype=np.float32)
+
+    vh_grid, vv_grid = np.meshgrid(vh_axis, vv_axis, indexing='ij')
+    X = np.stack((vh_grid.ravel(), vv_grid.ravel()), axis=1)
+
+    table = np.empty(len(X), dtype=np.uint8)
+    for i in range(0, len(X), batch):
+        table[i:i+batch] = model.predict(X[i:i+batch])
+
+    return {
+        'table': table.reshape(vh_grid.shape),
+        'vh_min': np.float32(vh_axis[0]),
+        'vv_min': np.float32(vv_axis[0]),
+        'step': np.float32(step)
+    }
+
+def save_lut(lut, lut_path, model_fp=''):
+    """Save the lookup table as a compressed .npz with the fingerprint of the model it was compiled from"""
+    np.savez_compressed(lut_path, **lut, model_fp=np.str_(model_fp))
+
+def lut_model_fingerprint(lut_path):
+    """Fingerprint of the model a saved lookup table was compiled from, '' for tables saved without it"""
+    with np.load(lut_path) as data:
+        return str(data['model_fp']) if 'model_fp' in data.files else ''
+
+def load_lut(lut_path):
+    """Load a lookup table saved by save_lut"""
+    with np.load(lut_path) as data:
+        return {key: data[key] for key in data.files}
+
+def lut_predict(lut, vh, vv):
+    """Classify (VH, VV) arrays of any shape with a vectorized table lookup"""
+
+    table = lut['table']
+    step = lut['step']
+
+    i = np.rint((np.nan_to_num(vh) - lut['vh_min']) / step)
+    j = np.rint((np.nan_to_num(vv) - lut['vv_min']) / step)
+
+    # Values beyond the grid get the prediction of its edge
+    i = np.clip(i, 0, table.shape[0] - 1).astype(np.intp)
+    j = np.clip(j, 0, table.shape[1] - 1).astype(np.intp)
+
+    return table[i, j]
+
+def lut_agreement(model, lut, X):
+    """Fraction of the pixels in X where the table agrees with the model"""
+
+    return float(np.mean(model.predict(X) == lut_predict(lut, X[:, 0], X[:, 1])))
+
+
+if __name__ == '__main__':
+    from joblib import load
+
+    # Load config
+    config = read_config('config.ini')
+
+    step = config.getfloat('Predict', 'LUT_Step', fallback=0.05)
+    lut_path = config['Predict']['LUT']
+
+    model_path = config['Predict']['Model']
+    clf = load(model_path)
+
+    print(f'Compiling {model_path} with a {step} dB step')
+    lut = compile_lut(clf, step)
+    save_lut(lut, lut_path, file_fingerprint(model_path))
+    print(f'Lookup table {lut["table"].shape} saved to {lut_path}')
+
+    # Held-out pixels, same layout as the training data (VH, VV, label rows)
+    # or random pixels over the table range if not provided
+    holdout_path = config['Predict'].get('LUT_Holdout')
+    if holdout_path:
+        data = np.load(holdout_path)
+        X = np.stack((data[0], data[1]), axis=1)
+    else:
+        rng = np.random.default_rng(0)
+        shape = lut['table'].shape
+        X = np.stack((rng.uniform(lut['vh_min'], lut['vh_min'] + shape[0] * step, 1_000_000),
+                      rng.uniform(lut['vv_min'], lut['vv_min'] + shape[1] * step, 1_000_000)), axis=1)
+
+    print(f'Agreement with the model: {lut_agreement(clf, lut, X.astype(np.float32)):.4%} on {len(X)} pixels')
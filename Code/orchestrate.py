@@ -0,0 +1,323 @@
+"""Pipelined replacement of start.sh.
+
+Every product moves to the next stage as soon as its previous stage is done,
+so downloads, SNAP and prediction run at the same time on different products.
+Runs once (cron) or with --loop as a long-running service. Products are
+claimed with leases in the DB, so orchestrators on several nodes can share it.
+"""
+from utils import read_config, create_connection
+import os
+import sys
+import time
+import fcntl
+import sqlite3
+import subprocess
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from download_products import create_session, fetch_product, load_verified, save_verified
+from product_state import STAGES, lease_owner, claim, complete, release, Heartbeat
+from metrics import Timings, record_metrics, lifetime_peak_rss_mb, start_metrics_server
+from predict_indexed import read_predict_config, load_classifier, result_fingerprints, predict_product
+
+# datacube, pyroSAR, GDAL and the classifier are loaded when a stage needing them is first claimed,
+# so a cron run that finds nothing to do exits without them
+
+CODE_DIR = Path(__file__).resolve().parent
+
+
+def acquire_lock(lock_path):
+    """Take an exclusive lock on lock_path, held until the process exits.
+    Returns the open lock file, or None if another orchestrator holds it"""
+
+    Path(lock_path).parent.mkdir(parents=True, exist_ok=True)
+    lock_file = open(lock_path, 'a+')
+
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+
+    return lock_file
+
+
+class Pipeline:
+    """Stage executors and the products running in them.
+    Workers only do the stage work, stage results are written on the calling thread.
+    What a stage needs is loaded by prepare() the first time one of its products is claimed"""
+
+    def __init__(self, config, con):
+        self.config = config
+        self.con = con
+        self.cur = con.cursor()
+        self.min_coverage = config.getfloat('Preprocess', 'Min_Coverage', fallback=0)
+
+        # Download
+        dl_workers = config.getint('Download', 'Workers', fallback=1)
+        self.dl_path = config['Path']['Download']
+        self.retries = config.getint('Download', 'Retries', fallback=5)
+        self.backoff = config.getfloat('Download', 'Backoff', fallback=2)
+        self.cache_path = config.get('Download', 'Verified_Cache', fallback='') or os.path.join(self.dl_path, '.verified.json')
+        self.cache = load_verified(self.cache_path)
+        self.session = create_session(config, config.getint('Download', 'Connections_Per_Host', fallback=dl_workers))
+
+        # Preprocess
+        prep_workers = config.getint('Preprocess', 'Workers', fallback=1)
+        self.prep_path = config['Path']['Preprocess']
+        self.prep_options = None
+
+        # Index and predict share one datacube connection
+        self.product_name = config['Preprocess']['Product_Name']
+        self.dc = None
+        self.resolver = None
+
+        self.results_path = config['Path']['Results']
+        self.predict_options = read_predict_config(config)
+        self.clf = None
+
+        # Each predicted product already uses [Predict] Workers tile threads and Memory_Budget
+        predict_workers = config.getint('Orchestrator', 'Predict_Workers', fallback=1)
+
+        self.executors = {
+            'download': ThreadPoolExecutor(max_workers=dl_workers),
+            # Spawned, so SNAP workers don't inherit the datacube connection
+            'preprocess': ProcessPoolExecutor(max_workers=prep_workers, mp_context=multiprocessing.get_context('spawn')),
+            'index': ThreadPoolExecutor(max_workers=1),
+            'predict': ThreadPoolExecutor(max_workers=predict_workers)
+        }
+        self.workers = {'download': dl_workers, 'preprocess': prep_workers, 'index': 1, 'predict': predict_workers}
+
+        # Leases on the products running here, each renewed by its own heartbeat thread
+        # so they stay valid while the main thread waits, e.g. in close()
+        self.db_path = config['Path']['Database']
+        self.owner = lease_owner()
+        self.lease_seconds = config.getfloat('Database', 'Lease_Seconds', fallback=300)
+        self.retry_delay = config.getfloat('Database', 'Retry_Delay', fallback=600)
+
+        # future: (stage, product, timings, heartbeat)
+        self.running = {}
+
+    def prepare(self, stage):
+        """Load what a stage needs, once"""
+
+        if stage == 'preprocess' and self.prep_options is None:
+            from preprocess_products import read_preprocess_config
+            self.prep_options = read_preprocess_config(self.config, self.workers['preprocess'])
+
+        if stage in ('index', 'predict') and self.dc is None:
+            import datacube
+            from datacube.index.hl import Doc2Dataset
+            self.dc = datacube.Datacube(app="orchestrate")
+            self.resolver = Doc2Dataset(self.dc.index, products=[self.product_name])
+
+        if stage == 'predict' and self.clf is None:
+            if self.predict_options['acc_path']:
+                from accumulator import init_accumulator
+                init_accumulator(self.predict_options['acc_path'], self.config['Preprocess']['SHP'])
+            self.clf, model_fp = load_classifier(self.config)
+            self.classifier_fp, self.result_fp = result_fingerprints(model_fp, self.predict_options['holes_threshold'],
+                                                                     self.predict_options['objects_threshold'],
+                                                                     self.predict_options['cleanup'], self.predict_options['halo'])
+
+    def busy(self):
+        """If any stage is running"""
+        return bool(self.running)
+
+    def submit(self, stage, product):
+        """Run a stage of a product on its executor"""
+
+        self.prepare(stage)
+
+        timings = Timings()
+        timings.set('started', time.perf_counter())
+
+        if stage == 'download':
+            future = self.executors[stage].submit(fetch_product, self.session, product, self.dl_path, self.retries,
+                                                  self.backoff, self.cache, timings)
+        elif stage == 'preprocess':
+            from preprocess_products import preprocess_product
+            future = self.executors[stage].submit(preprocess_product, product, **self.prep_options)
+        elif stage == 'index':
+            from index_preprocessed import index_product
+            future = self.executors[stage].submit(index_product, self.dc, self.resolver, product, self.prep_path)
+        else:
+            future = self.executors[stage].submit(predict_product, self.dc, self.clf, self.classifier_fp, product,
+                                                  self.product_name, self.results_path, **self.predict_options,
+                                                  timings=timings)
+
+        heartbeat = Heartbeat(self.db_path, self.owner, [product['id']], self.lease_seconds)
+        heartbeat.start()
+
+        print(f"[{stage}] Started: {product['title']}")
+        self.running[future] = (stage, product, timings, heartbeat)
+
+    def fill(self):
+        """Claim waiting products for every stage with free workers.
+        Returns the number of products submitted"""
+
+        submitted = 0
+        for stage in STAGES:
+            free = self.workers[stage] - sum(1 for s, *_ in self.running.values() if s == stage)
+            if free <= 0:
+                continue
+
+            min_coverage = self.min_coverage if stage in ('download', 'preprocess') else None
+            for product in claim(self.con, stage, self.owner, self.lease_seconds, free, min_coverage):
+                self.submit(stage, product)
+                submitted += 1
+
+        return submitted
+
+    def stage_metrics(self, stage, result, timings):
+        """Metrics of a finished stage, the preprocess worker process returns its own"""
+
+        started = timings.values.pop('started')
+        if stage == 'preprocess':
+            return result[1]
+
+        return {'seconds': time.perf_counter() - started, **timings.values, 'lifetime_peak_rss_mb': lifetime_peak_rss_mb()}
+
+    def stage_values(self, stage, result):
+        """Columns to update from the result of a stage and if it succeeded"""
+
+        if stage == 'download':
+            checksum, downloaded = result
+            return {'checksum': checksum, 'downloaded': int(downloaded)}, downloaded
+        if stage == 'preprocess':
+            success, _ = result
+            return ({'preprocessed': 1} if success else {}), success
+        if stage == 'index':
+            # No index file, preprocess again
+            return ({'indexed': 1} if result else {'preprocessed': 0}), True
+
+        return {'detected': 1, 'classifier_fp': self.classifier_fp, 'result_fp': self.result_fp}, True
+
+    def finish(self, future):
+        """Record the result of a finished stage and release its lease.
+        Failed products aren't claimed again by any worker for Retry_Delay seconds"""
+
+        stage, product, timings, heartbeat = self.running.pop(future)
+        heartbeat.stop()
+
+        if future.cancelled():
+            complete(self.cur, product['id'], self.owner, {})
+            return
+
+        try:
+            result = future.result()
+            values, success = self.stage_values(stage, result)
+            record_metrics(self.cur, product['id'], stage, self.stage_metrics(stage, result, timings))
+        except Exception as e:
+            print(f"[{stage}] Failed: {product['title']}: {e}")
+            values, success = {}, False
+
+        if not complete(self.cur, product['id'], self.owner, values, None if success else self.retry_delay):
+            print(f"[{stage}] Lease expired, result dropped: {product['title']}")
+        elif success:
+            print(f"[{stage}] Done: {product['title']}")
+        else:
+            print(f"[{stage}] Failed: {product['title']}, retrying in {self.retry_delay:.0f}s")
+
+    def collect(self, futures):
+        """Record the finished futures in a single transaction"""
+
+        if not futures:
+            return
+
+        with self.con:
+            for future in futures:
+                self.finish(future)
+
+        save_verified(self.cache_path, self.cache)
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for running stages and record the finished ones"""
+
+        if not self.running:
+            time.sleep(timeout)
+            return
+
+        done, _ = wait(list(self.running), timeout=timeout, return_when=FIRST_COMPLETED)
+        self.collect(done)
+
+    def close(self):
+        """Wait for the running stages, record them and close the datacube connection if it was opened.
+        Products that never started (or whose stage failed to load) get their lease back"""
+
+        for executor in self.executors.values():
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        self.collect(list(self.running))
+        release(self.con, self.owner)
+        if self.dc is not None:
+            self.dc.close()
+
+
+def start_sync():
+    """Run sync_s1_products.py in the background"""
+    return subprocess.Popen([sys.executable, str(CODE_DIR / 'sync_s1_products.py')])
+
+
+if __name__ == '__main__':
+    # python orchestrate.py         process everything and exit (cron)
+    # python orchestrate.py --loop  keep running and sync every Sync_Interval
+    loop = '--loop' in sys.argv
+
+    config = read_config('config.ini')
+
+    poll_interval = config.getfloat('Orchestrator', 'Poll_Interval', fallback=10)
+    sync_interval = config.getfloat('Orchestrator', 'Sync_Interval', fallback=600)
+    lock_path = config.get('Orchestrator', 'Lock', fallback='') or os.path.join(config['Path']['Temporary'], 'orchestrate.lock')
+
+    lock = acquire_lock(lock_path)
+    if lock is None:
+        print(f'Another orchestrator holds {lock_path}')
+        sys.exit()
+
+    print(f'--- Started: {time.strftime("%T")} ---')
+
+    con = create_connection(config['Path']['Database'])
+    con.row_factory = sqlite3.Row
+
+    pipeline = Pipeline(config, con)
+
+    # Prometheus /metrics while the orchestrator runs
+    metrics_port = config['Metrics'].get('Port') if config.has_section('Metrics') else None
+    if metrics_port:
+        start_metrics_server(config['Path']['Database'], int(metrics_port), config['Metrics'].get('Host', '127.0.0.1'))
+
+    sync = start_sync()
+    last_sync = time.monotonic()
+
+    try:
+        while True:
+            if sync is not None and sync.poll() is not None:
+                sync = None
+
+            if loop and sync is None and time.monotonic() - last_sync >= sync_interval:
+                sync = start_sync()
+                last_sync = time.monotonic()
+
+            submitted = pipeline.fill()
+
+            if not loop and sync is None and not submitted and not pipeline.busy():
+                break
+
+            pipeline.wait(poll_interval)
+    except KeyboardInterrupt:
+        print('Exiting...')
+    finally:
+        if sync is not None:
+            sync.wait()
+        pipeline.close()
+        con.close()
+        lock.close()
+
+    print(f'--- Finished: {time.strftime("%T")} ---')
@@ -1,21 +1,50 @@
 import os
-import datacube
+import sys
+import time
+import math
+import signal
+import select
+import hashlib
 import sqlite3
 from datetime import datetime
 from pathlib import Path
-from joblib import load
-from utils import read_config, create_connection
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+from utils import read_config, create_connection, file_fingerprint, daemon_pid_path, hold_pid_file
+from model_lut import load_lut, lut_predict, lut_model_fingerprint
+from metrics import Timings, record_metrics, lifetime_peak_rss_mb
+from product_state import lease_owner, claim, complete, release, Heartbeat
 
 import numpy as np
-import xarray as xr
-import rioxarray as rio
-import rasterio
-from rasterio.merge import merge
-from skimage import morphology
+
+# datacube, xarray, rasterio, skimage and the model are imported where they are used,
+# so a run that finds nothing to predict exits without loading them
 
 import warnings
 warnings.filterwarnings('ignore')
 
+# Output values: 0 not water, 1 water, NODATA outside the valid data
+NODATA = 255
+
+# Resolution of the S1_GRD product in degrees
+RES = 0.00008983
+
+# Tile size of the output GeoTIFF
+BLOCK_SIZE = 512
+
+# Bump when the classification or the holes/objects cleanup code changes,
+# so existing results are picked up as stale
+CODE_VERSION = '2'
+
+# Peak working memory per loaded pixel of predict_tile, measured with tracemalloc on a tile
+# without nodata, plus the VH, VV float32 arrays dc.load allocates (8 B).
+# Both paths hold the valid VH/VV copies, the predictions, masks and skimage label images,
+# the model also the float32 features and sklearn's float64 class probabilities
+LUT_BYTES_PER_PIXEL = 42
+MODEL_BYTES_PER_PIXEL = 66
+# Every extra thread of a forest's predict holds its own tree probabilities and leaf indices
+MODEL_THREAD_BYTES_PER_PIXEL = 24
+
 def get_img_min_max_xy(dc, prd, dt):
     """
     Get the minimum and maximum x, y values of an image
@@ -40,33 +69,260 @@ def get_img_min_max_xy(dc, prd, dt):
 def predict_water(pipeline, dc):
     """
     Predict water pixels in an image.
+    pipeline is the sklearn model or a lookup table compiled by model_lut.py
+    Only valid pixels are classified, nodata (0/NaN in VH or VV) is marked as NODATA
     """
 
-    vh = dc['VH'].values.squeeze()
-    vv = dc['VV'].values.squeeze()
-  
-    img_shape = vh.shape
-    X = np.stack((vh.flatten(), vv.flatten()), axis=1)
+    # Single time step, squeeze() would also drop a 1-pixel row or column dimension
+    vh = dc['VH'].isel(time=0).values
+    vv = dc['VV'].isel(time=0).values
+
+    # Valid pixels, compacted contiguously
+    valid = np.isfinite(vh) & np.isfinite(vv) & (vh != 0) & (vv != 0)
+    vh, vv = vh[valid], vv[valid]
+
+    p = np.full(valid.shape, NODATA, dtype=np.uint8)
+
+    if not vh.size:
+        return p
+
+    if isinstance(pipeline, dict):
+        p[valid] = lut_predict(pipeline, vh, vv)
+        return p
+
+    X = np.stack((vh, vv), axis=1)
     
-    predictions = pipeline.predict(X)
+    p[valid] = pipeline.predict(X)
     
     del X
     
-    p = predictions.reshape((img_shape))
-    
     return p
 
 
+def output_grid(min_x, min_y, max_x, max_y, res=RES):
+    """
+    Pixel grid of the whole image, aligned to the resolution like dc.load aligns it.
+    Returns the transform, width and height
+    """
+    left, right = math.floor(min_x / res) * res, math.ceil(max_x / res) * res
+    bottom, top = math.floor(min_y / res) * res, math.ceil(max_y / res) * res
+
+    width = round((right - left) / res)
+    height = round((top - bottom) / res)
+
+    from rasterio.transform import from_origin
+
+    return from_origin(left, top, res, res), width, height
+
+
+def create_output_img(img_path, transform, width, height, compress='LZW'):
+    """
+    Create the final tiled GeoTIFF up front, every pixel starts as nodata
+    """
+    import rasterio
+
+    options = {'compress': compress} if compress else {}
+
+    return rasterio.open(img_path, 'w', driver='GTiff',
+                         width=width, height=height, count=1, dtype='uint8',
+                         crs='epsg:4326', transform=transform, nodata=NODATA,
+                         tiled=True, blockxsize=BLOCK_SIZE, blockysize=BLOCK_SIZE,
+                         BIGTIFF='IF_SAFER', **options)
+
+
+def bytes_per_pixel(clf):
+    """
+    Working memory per loaded pixel of predict_tile with the lookup table or the model,
+    including the threads the model predicts with
+    """
+    if isinstance(clf, dict):
+        return LUT_BYTES_PER_PIXEL
+
+    from joblib import effective_n_jobs
+
+    # Last step of a Pipeline
+    model = clf.steps[-1][1] if hasattr(clf, 'steps') else clf
+    threads = min(effective_n_jobs(getattr(model, 'n_jobs', None)), max(len(getattr(model, 'estimators_', [])), 1))
+
+    return MODEL_BYTES_PER_PIXEL + MODEL_THREAD_BYTES_PER_PIXEL * (threads - 1)
+
+
+def plan_tiles(width, height, memory_mb, halo, pixel_bytes=MODEL_BYTES_PER_PIXEL):
+    """
+    Split the image in 2-D tiles that fit, with their halo, in memory_mb
+    at pixel_bytes per loaded pixel. Tile sides are multiples of the output block size.
+    Returns (row_start, row_end, col_start, col_end) of every tile without its halo
+    """
+    max_pixels = memory_mb * 1024 * 1024 / pixel_bytes
+    side = int(math.sqrt(max_pixels)) - 2 * halo
+    if side < BLOCK_SIZE:
+        needed = (BLOCK_SIZE + 2 * halo) ** 2 * pixel_bytes / 1024 / 1024
+        print(f'A {halo} px halo does not fit in {memory_mb} MB per worker, tiles will use ~{needed:.0f} MB each. '
+              'Raise Memory_Budget, lower Workers or Tile_Halo, or use Cleanup = global')
+    side = max(BLOCK_SIZE, side // BLOCK_SIZE * BLOCK_SIZE)
+
+    return [(r0, min(r0 + side, height), c0, min(c0 + side, width))
+            for r0 in range(0, height, side)
+            for c0 in range(0, width, side)]
+
+
+def load_window(dc, product_name, dt, transform, r0, r1, c0, c1, res=RES):
+    """
+    Load rows r0 - r1 and columns c0 - c1 of the image grid.
+    Bounds are half a pixel inside so dc.load snaps exactly to them
+    """
+    left, top = transform.c, transform.f
+
+    return dc.load(product=product_name,
+        time=(dt, dt),
+        y = (top - r1 * res + res / 2, top - r0 * res - res / 2),
+        x = (left + c0 * res + res / 2, left + c1 * res - res / 2),
+        resolution = (-res, res),
+        resampling='nearest'
+    )
+
+
+def clean_water(p_w, holes_threshold, objects_threshold):
+    """
+    Remove small holes/objects from the water mask, nodata stays nodata
+    """
+    from skimage import morphology
+
+    # Object/Holes threshold
+    valid = p_w != NODATA
+    water = p_w == 1
+
+    # Remove holes/objects. Like global_cleanup, nodata counts towards the hole areas
+    # but is never filled, so it doesn't add to the object areas either
+    water = morphology.remove_small_holes(water, area_threshold=holes_threshold) & valid
+    water = morphology.remove_small_objects(water, min_size=objects_threshold)
+
+    return np.where(valid, water, NODATA).astype(np.uint8)
+
+
+def predict_tile(tile, dc, clf, product_name, dt, transform, halo, width, height, holes_threshold, objects_threshold, clean=True, timings=None):
+    """
+    Load, classify and clean one tile with its halo.
+    Returns the tile and its cleaned water mask without the halo, or None if there is no data.
+    With clean=False the raw classification is returned.
+    Load, predict and morphology seconds and the classified pixels are added to timings
+    """
+    if timings is None:
+        timings = Timings()
+
+    r0, r1, c0, c1 = tile
+
+    # Tile with its halo, clipped to the image
+    hr0, hr1 = max(r0 - halo, 0), min(r1 + halo, height)
+    hc0, hc1 = max(c0 - halo, 0), min(c1 + halo, width)
+
+    with timings.time('load_s'):
+        ds = load_window(dc, product_name, dt, transform, hr0, hr1, hc0, hc1)
+    if not ds:
+        return tile, None
+
+    with timings.time('predict_s'):
+        cleaned_w = predict_water(clf, ds)
+    timings.add('pixels', cleaned_w.size)
+
+    if clean:
+        with timings.time('morphology_s'):
+            cleaned_w = clean_water(cleaned_w, holes_threshold, objects_threshold)
+
+    # Position of the loaded pixels on the image grid
+    lat = ds['latitude'].values
+    lon = ds['longitude'].values
+    row_off = round((transform.f - (lat[0] + RES / 2)) / RES)
+    col_off = round(((lon[0] - RES / 2) - transform.c) / RES)
+
+    del ds
+
+    # Crop the halo, pixels that weren't loaded stay nodata
+    out = np.full((r1 - r0, c1 - c0), NODATA, dtype=np.uint8)
+
+    sr0, sr1 = max(r0, row_off), min(r1, row_off + cleaned_w.shape[0])
+    sc0, sc1 = max(c0, col_off), min(c1, col_off + cleaned_w.shape[1])
+    if sr1 > sr0 and sc1 > sc0:
+        out[sr0 - r0:sr1 - r0, sc0 - c0:sc1 - c0] = cleaned_w[sr0 - row_off:sr1 - row_off, sc0 - col_off:sc1 - col_off]
+
+    return tile, out
+
+
+def global_cleanup(raw_path, img_path, tiles, holes_threshold, objects_threshold):
+    """
+    Remove holes/objects measured over the whole image from the raw classification,
+    merging the components across tile borders.
+    The raw classification is left untouched
+    """
+    import rasterio
+    from components import remove_small_components
+
+    holes_path = f"{img_path}.holes"
+
+    # Fill holes into an uncompressed scratch image
+    with rasterio.open(raw_path) as raw:
+        with create_output_img(holes_path, raw.transform, raw.width, raw.height, compress=None) as dst:
+            remove_small_components(raw, dst, tiles, lambda a: a != 1, holes_threshold, 1, nodata=NODATA)
+
+    # Remove objects while writing the final image
+    with rasterio.open(holes_path) as raw:
+        with create_output_img(img_path, raw.transform, raw.width, raw.height) as dst:
+            remove_small_components(raw, dst, tiles, lambda a: a == 1, objects_threshold, 0)
+
+    os.remove(holes_path)
+
+
+def result_fingerprints(model_fp, holes_threshold, objects_threshold, cleanup='tiles', halo=0):
+    """
+    Fingerprints of the raw classification (model file fingerprint, code version)
+    and of the final result (raw classification, thresholds, cleanup mode and,
+    for the tiles cleanup, the halo).
+    A lookup table compiled from the model gives the same fingerprints as the model
+    """
+    classifier_fp = hashlib.md5(f'{model_fp}:{CODE_VERSION}'.encode()).hexdigest()
+
+    # The global cleanup doesn't use the halo
+    cleanup_key = 'global' if cleanup == 'global' else f'tiles:{halo}'
+    result_fp = hashlib.md5(f'{classifier_fp}:{holes_threshold}:{objects_threshold}:{cleanup_key}'.encode()).hexdigest()
+
+    return classifier_fp, result_fp
+
+
+def run_tiles(executor, tiles, max_pending, func):
+    """
+    Run func(tile) for every tile, with at most max_pending tiles in memory.
+    Yields the results as they finish
+    """
+    tiles = iter(tiles)
+    pending = set()
+
+    while True:
+        for tile in tiles:
+            pending.add(executor.submit(func, tile))
+            if len(pending) >= max_pending:
+                break
+
+        if not pending:
+            return
+
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+
 def create_gt_img(water, lat, lon, full_path):
     """
     Create tiff of predicted water pixels in a chunk
     """
+    import xarray as xr
+    import rioxarray  # registers the .rio accessor
+
     xar = xr.DataArray(water, coords={'y': lat, 'x': lon}, dims=['y', 'x'])
     xar.name = 'water'
 
     xar = xar.transpose('y', 'x')
     xar.rio.write_crs("epsg:4326", inplace=True)
-    xar.rio.write_nodata(0, inplace=True)
+    xar.rio.write_nodata(NODATA, inplace=True)
     xar.rio.set_spatial_dims(x_dim="x", y_dim='y', inplace=True)
 
     xar.rio.to_raster(f"{full_path}.tif", compress='LZW', dtype='uint8')
@@ -76,6 +332,9 @@ def merge_images(full_path, name):
     """
     Merge all tiffs of chunks to form the final image
     """
+    import rasterio
+    from rasterio.merge import merge
+
     products = [full_path + "/" + product for product in os.listdir(full_path) if product.startswith(f'{name}_')]
     src_files_to_mosaic = []
 
@@ -109,105 +368,338 @@ def merge_images(full_path, name):
         os.remove(product)
 
 
-if __name__ == '__main__':
+def read_predict_config(config):
+    """Prediction settings shared by predict_indexed.py and the orchestrator"""
+
+    options = {
+        'holes_threshold': int(config['Predict']['Holes_Threshold']),
+        'objects_threshold': int(config['Predict']['Objects_Threshold']),
+        # Memory (MB) shared by the tile workers
+        'memory_budget': config.getint('Predict', 'Memory_Budget', fallback=4096),
+        'workers': config.getint('Predict', 'Workers', fallback=os.cpu_count()),
+        # Remove holes/objects per tile with a halo (tiles) or over the whole image (global)
+        'cleanup': config['Predict'].get('Cleanup', 'tiles'),
+        # Raw classification masks kept to re-run only the cleanup, empty to disable
+        'raw_cache': config['Predict'].get('Raw_Cache') or None,
+        # Persistent per-pixel accumulators on the AOI grid
+        'acc_path': config['Predict'].get('Accumulator') or None,
+    }
+
+    # A hole filled at the tile edge can join a small object, so the halo covers both thresholds.
+    # Tiles usually match the whole image, but chains of such components can still reach past
+    # the halo, only Cleanup = global is exact
+    halo = config['Predict'].get('Tile_Halo')
+    options['halo'] = int(halo) if halo else options['holes_threshold'] + options['objects_threshold']
+
+    # Cached raw classifications are cleaned over the whole image
+    if options['raw_cache'] and options['cleanup'] != 'global':
+        print('Raw_Cache is set, using Cleanup = global')
+        options['cleanup'] = 'global'
+
+    return options
+
+
+def classifier_path(config):
+    """
+    Path of the compiled lookup table if it was compiled from the current model, otherwise of the model.
+    Returns the path, if it is a lookup table and the fingerprint of the model
+    """
+    model_path = config['Predict']['Model']
+    lut_path = config['Predict'].get('LUT')
+    if not lut_path or not Path(lut_path).is_file():
+        return model_path, False, file_fingerprint(model_path)
+
+    lut_fp = lut_model_fingerprint(lut_path)
+
+    # Only the table is deployed, nothing to compare it to
+    if not Path(model_path).is_file() and lut_fp:
+        return lut_path, True, lut_fp
+
+    model_fp = file_fingerprint(model_path)
+    if lut_fp == model_fp:
+        return lut_path, True, model_fp
+
+    print(f'{lut_path} was not compiled from {model_path}, using the model. Run model_lut.py to recompile it')
+    return model_path, False, model_fp
+
+
+def load_classifier(config):
+    """
+    Load the compiled lookup table if there is one, otherwise the model.
+    Returns the classifier and the fingerprint of the model
+    """
+    path, is_lut, model_fp = classifier_path(config)
+    if is_lut:
+        return load_lut(path), model_fp
+
+    from joblib import load
+    return load(path), model_fp
+
+
+def open_predictor(config, options):
+    """
+    Import the heavy modules, connect to the datacube, load the classifier
+    and create the accumulators. Returns the datacube and the classifier
+    """
+    import datacube
+
+    if options['acc_path']:
+        from accumulator import init_accumulator
+        init_accumulator(options['acc_path'], config['Preprocess']['SHP'])
+
     dc = datacube.Datacube(app="predict_cut")
+    clf, _ = load_classifier(config)
+
+    return dc, clf
+
+
+def run_claimed(config, con, options, classifier_fp, result_fp, predictor=None, wait=None):
+    """
+    Claim indexed products one at a time with a lease and predict them, so runs, daemons
+    and orchestrators never predict the same product. predictor is the (datacube, classifier)
+    from open_predictor, loaded on the first claimed product if not given.
+    Without wait, returns once nothing is left to claim, otherwise calls wait() and checks again.
+    Returns the number of products predicted
+    """
+    db_path = config['Path']['Database']
+    results_path = config['Path']['Results']
+    product_name = config['Preprocess']['Product_Name']
+    lease_seconds = config.getfloat('Database', 'Lease_Seconds', fallback=300)
+    retry_delay = config.getfloat('Database', 'Retry_Delay', fallback=600)
+
+    owner = lease_owner()
+    cur = con.cursor()
+    opened = predictor is None
+    predicted = 0
+
+    try:
+        while True:
+            products = claim(con, 'predict', owner, lease_seconds)
+            if not products:
+                if wait is None:
+                    return predicted
+                wait()
+                continue
+
+            product = products[0]
+            print('Predicting water for: ', product['title'])
+
+            timings = Timings()
+            try:
+                with Heartbeat(db_path, owner, [product['id']], lease_seconds):
+                    # Only now that there is work, load the datacube and the classifier
+                    if predictor is None:
+                        predictor = open_predictor(config, options)
+                    dc, clf = predictor
+                    predict_product(dc, clf, classifier_fp, product, product_name, results_path, **options, timings=timings)
+            except Exception as e:
+                print(f"Failed to predict {product['title']}: {e}")
+                with con:
+                    complete(cur, product['id'], owner, {}, retry_delay)
+                continue
+
+            with con:
+                if not complete(cur, product['id'], owner, {'detected': 1, 'classifier_fp': classifier_fp, 'result_fp': result_fp}):
+                    print('Lease expired, result dropped: ', product['title'])
+                    continue
+                record_metrics(cur, product['id'], 'predict', {**timings.values, 'lifetime_peak_rss_mb': lifetime_peak_rss_mb()})
+
+            predicted += 1
+            print('Predicted :', product['title'])
+    finally:
+        release(con, owner)
+        if opened and predictor is not None:
+            predictor[0].close()
+
+
+def run_daemon(config, con, options, classifier_fp, result_fp):
+    """
+    Keep the datacube connection, the classifier and the imports loaded and predict
+    products as soon as they are indexed. Products are claimed with a lease, so the
+    daemon can run next to orchestrators. Woken up by SIGUSR1 (index_preprocessed.py)
+    or every Poll_Interval seconds
+    """
+    poll_interval = config.getfloat('Predict', 'Poll_Interval', fallback=60)
+
+    # Locked as long as the daemon runs, notify_daemon only signals a locked PID file
+    pid_path = daemon_pid_path(config)
+    pid_file = hold_pid_file(pid_path)
+    if pid_file is None:
+        print(f'Another prediction daemon is running ({pid_path}), exiting')
+        return
+
+    dc, clf = open_predictor(config, options)
+
+    # The handler runs on the main thread in the middle of anything, so it takes no lock:
+    # Python itself writes every signal to the wakeup pipe the daemon sleeps on
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(read_fd, False)
+    os.set_blocking(write_fd, False)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: None)
+    previous_fd = signal.set_wakeup_fd(write_fd)
+
+    def wait():
+        select.select([read_fd], [], [], poll_interval)
+        # Signals received while predicting wake it only once
+        try:
+            while os.read(read_fd, 512):
+                pass
+        except BlockingIOError:
+            pass
+
+    print('Waiting for indexed products')
+    try:
+        run_claimed(config, con, options, classifier_fp, result_fp, (dc, clf), wait)
+    finally:
+        signal.set_wakeup_fd(previous_fd)
+        os.close(read_fd)
+        os.close(write_fd)
+        # Removed while still locked, so it is never another daemon's file
+        os.remove(pid_path)
+        pid_file.close()
+        dc.close()
+
+
+def predict_product(dc, clf, classifier_fp, product, product_name, results_path, holes_threshold, objects_threshold,
+                    memory_budget, workers, cleanup='tiles', halo=0, raw_cache=None, acc_path=None, timings=None):
+    """
+    Predict the water of one indexed product into Results/YYYY/MM/<title>.tif.
+    DB updates are left to the caller. Step seconds (summed over the tile workers),
+    pixels and pixels/s are recorded in timings
+    """
+    from rasterio.windows import Window
+    from accumulator import replace_product
+
+    if timings is None:
+        timings = Timings()
+    start = time.perf_counter()
+
+    product_title = product['title']
+
+    # Get datetime of product in the desired datacube format
+    dt_strp = datetime.strptime(product['beginposition'], '%Y-%m-%dT%H:%S:%M.%fZ')
+    dt_strf = dt_strp.strftime("%Y-%m-%dT%H:%S:%M")
+    year = dt_strp.strftime("%Y")
+    month = dt_strp.strftime("%m")
+
+    # Create full path to predicted file and
+    # check if folder exists and if not create it
+    full_path = os.path.join(results_path, year, month)
+    Path(full_path).mkdir(parents=True, exist_ok=True)
+
+    # Get image minimum and maximum x, y
+    min_x, min_y, max_x, max_y = get_img_min_max_xy(dc, product_name, dt_strf)
+
+    # Create the final image, tiles are written into it as they finish
+    transform, width, height = output_grid(min_x, min_y, max_x, max_y)
+    img_path = os.path.join(full_path, f"{product_title}.tif")
+
+    # Cached raw classification of the product
+    raw_path = os.path.join(raw_cache, year, month, f"{product_title}.tif") if raw_cache else f"{img_path}.raw"
+    reuse_raw = bool(raw_cache) and product.get('classifier_fp') == classifier_fp and Path(raw_path).is_file()
+
+    # Classify into a raw image (cached or for the global cleanup), or clean tiles with their halo
+    # (read_predict_config already switches to Cleanup = global when Raw_Cache is set)
+    keep_raw = bool(raw_cache) or cleanup == 'global'
+
+    # Tiles sized so that all workers together stay within the memory budget.
+    # Global cleanup measures components over the whole image, so tiles need no halo
+    tile_halo = 0 if keep_raw else halo
+    tiles = plan_tiles(width, height, memory_budget // workers, tile_halo, bytes_per_pixel(clf))
+
+    if reuse_raw:
+        print('Classifier unchanged, reusing: ', raw_path)
+    else:
+        print(f'{len(tiles)} tiles, {workers} workers')
+
+        Path(raw_path).parent.mkdir(parents=True, exist_ok=True)
+        # Raw images are only moved in place when complete, a cached one is never partial
+        out_path = f"{raw_path}.part" if keep_raw else f"{img_path}.part"
+        # A temporary raw image is written uncompressed
+        compress = None if keep_raw and not raw_cache else 'LZW'
+
+        with create_output_img(out_path, transform, width, height, compress) as dst, \
+                ThreadPoolExecutor(max_workers=workers) as executor:
+
+            tile_func = partial(predict_tile, dc=dc, clf=clf, product_name=product_name, dt=dt_strf,
+                                transform=transform, halo=tile_halo, width=width, height=height,
+                                holes_threshold=holes_threshold, objects_threshold=objects_threshold,
+                                clean=not keep_raw, timings=timings)
+
+            for tile, cleaned_w in run_tiles(executor, tiles, workers, tile_func):
+                if cleaned_w is None:
+                    continue
+
+                r0, r1, c0, c1 = tile
+                with timings.time('write_s'):
+                    dst.write(cleaned_w, 1, window=Window(c0, r0, c1 - c0, r1 - r0))
+
+                del cleaned_w
+
+        if keep_raw:
+            os.replace(out_path, raw_path)
+
+    if keep_raw:
+        with timings.time('morphology_s'):
+            global_cleanup(raw_path, f"{img_path}.part", tiles, holes_threshold, objects_threshold)
+        if not raw_cache:
+            os.remove(raw_path)
+
+    if acc_path:
+        # Move the result in place and update the per-pixel water frequency,
+        # from the previous result of a re-detected product in one pass
+        with timings.time('accumulator_s'):
+            replace_product(acc_path, product_title, img_path, dt_strp.date(), f"{img_path}.part")
+    else:
+        os.replace(f"{img_path}.part", img_path)
+
+    predict_s = timings.values.get('predict_s', 0)
+    timings.set('pixels_per_s', timings.values.get('pixels', 0) / predict_s if predict_s else 0)
+    timings.set('seconds', time.perf_counter() - start)
+
+    return img_path
+
+
+if __name__ == '__main__':
+    # python predict_indexed.py           predict the indexed products and exit
+    # python predict_indexed.py redetect  also recompute results of another model, thresholds or code version
+    # python predict_indexed.py daemon    stay loaded and predict products as they are indexed
+    mode = sys.argv[1] if len(sys.argv) > 1 else None
 
     # Load config
     config = read_config('config.ini')
-    results_path = config['Path']['Results']
 
-    product_name = config['Preprocess']['Product_Name']
-    clf = load(config['Predict']['Model'])
+    options = read_predict_config(config)
+    _, _, model_fp = classifier_path(config)
+
+    # Results made with another model, thresholds or code version are stale
+    classifier_fp, result_fp = result_fingerprints(model_fp, options['holes_threshold'], options['objects_threshold'],
+                                                   options['cleanup'], options['halo'])
 
     # Create SQLite connection
     con = create_connection(config['Path']['Database'])
     con.row_factory = sqlite3.Row
     cur = con.cursor()
 
-    products_indexed = cur.execute('SELECT * FROM s1_products WHERE indexed=1 AND detected=0 ORDER BY beginposition DESC')
-    products_indexed = [dict(row) for row in cur.fetchall()]
-
-    # Iterate through products/images that haven't been predicted yet
-    if products_indexed:
-        for product in products_indexed:
-            product_title = product['title']
-            print('Predicting water for: ', product_title)
-            
-            # Get datetime of product in the desired datacube format
-            dt_strp = datetime.strptime(product['beginposition'], '%Y-%m-%dT%H:%S:%M.%fZ')
-            dt_strf = dt_strp.strftime("%Y-%m-%dT%H:%S:%M")
-            year = dt_strp.strftime("%Y")
-            month = dt_strp.strftime("%m")
-
-            # Create full path to predicted file and
-            # check if folder exists and if not create it
-            full_path = os.path.join(results_path, year, month)
-            Path(full_path).mkdir(parents=True, exist_ok=True)
-
-            # Get image minimum and maximum x, y
-            min_x, min_y, max_x, max_y = get_img_min_max_xy(dc, product_name, dt_strf)
-
-            # Break image in smaller chunks based on min and max y
-            # to conserve on RAM usage
-            # Every chunk is 0.5 degrees of Latitude about 55km - ~5500 image height
-            res = int(max_y - min_y) if int(max_y - min_y) != 0 else 0.5 
-        
-            # Iterate for every chunk
-            for i in range(0, int(res*20), 5):
-                # Create full path to predicted file and
-                # check if folder exists and if not create it
-                file_path = os.path.join(full_path, f"{product_title}_{i}")
-
-                # Calculate the desired chunk
-                i_l = i/10
-                min_y_l, max_y_l = min_y+i_l, min_y+i_l+0.5
-
-                if max_y < max_y_l:
-                    max_y_l = max_y
-                    
-                if min_y_l > max_y_l:
-                    break
-
-                # Load the desired chunk
-                ds = dc.load(product=product_name,
-                    time=(dt_strf, dt_strf),
-                    y = (min_y_l, max_y_l),
-                    x = (min_x, max_x),
-                    resolution = (-0.00008983, 0.00008983),
-                    resampling='nearest'
-                )
-                
-                # Predict the selected chunk
-                p_w = predict_water(clf, ds)
-
-                # Object/Holes threshold
-                p_w = xr.where(p_w == 1, True, False)
-                
-                # Remove holes/objects
-                cleaned_w = morphology.remove_small_holes(p_w, area_threshold=int(config['Predict']['Holes_Threshold']))
-                cleaned_w = morphology.remove_small_objects(cleaned_w, min_size=int(config['Predict']['Objects_Threshold']))
-                
-                del p_w
-
-                # Get lat, long
-                lat_w = ds['latitude'].values.squeeze()
-                long_w = ds['longitude'].values.squeeze()
-
-                # Create image
-                cleaned_w = xr.where(cleaned_w == True, 1, 0)
-                create_gt_img(cleaned_w, lat_w, long_w, file_path)
-
-                del cleaned_w, lat_w, long_w
-            
-            # Merge all the tiffs created for one product
-            merge_images(full_path, product_title)
-
-            # Commit to DB
-            cur.execute('UPDATE s1_products SET detected = 1 WHERE id = ?', (product['id'],))
-            con.commit()
-
-            print('Predicted :', product_title)
-    else:
-        print('No products to predict')
-    
-    con.close()
\ No newline at end of file
+    if mode == 'daemon':
+        try:
+            run_daemon(config, con, options, classifier_fp, result_fp)
+        except KeyboardInterrupt:
+            print('Exiting...')
+        finally:
+            con.close()
+        sys.exit()
+
+    try:
+        if mode == 'redetect':
+            # Results of another model, thresholds or code version wait for prediction again
+            with con:
+                stale = cur.execute("UPDATE s1_products SET detected = 0 WHERE status='done' AND (result_fp IS NULL OR result_fp != ?)", (result_fp,)).rowcount
+            print(f'{stale} stale results to recompute')
+
+        if not run_claimed(config, con, options, classifier_fp, result_fp):
+            print('No products predicted')
+    except KeyboardInterrupt:
+        print('Exiting...')
+    finally:
+        con.close()
@@ -1,25 +1,75 @@
-from utils import create_connection, read_config, build_preprocessed_path
+from utils import create_connection, read_config, build_preprocessed_path, dem_cache_valid, read_aoi
+from metrics import Timings, record_metrics, lifetime_peak_rss_mb
+from product_state import lease_owner, claim, complete, release, Heartbeat
 from pyroSAR.snap import util
 from pyroSAR.datacube_util import Product, Dataset
 from pyroSAR.ancillary import find_datasets, groupby
 import os
 import sqlite3
+import shutil
+import tempfile
+import time
+import math
 from pathlib import Path
-from osgeo import gdal
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from osgeo import gdal, osr
 import fiona
+import uuid
+import yaml
+from shapely import wkt
+
+def cog_options(compression):
+    """Creation options of a Cloud-Optimized GeoTIFF with 512x512 tiles,
+    floating point predictor and internal overviews"""
+
+    return [
+        'BLOCKSIZE=512',
+        f'COMPRESS={compression}',
+        'PREDICTOR=FLOATING_POINT',
+        'OVERVIEWS=AUTO',
+        'BIGTIFF=IF_SAFER',
+        'NUM_THREADS=ALL_CPUS'
+    ]
+
+def convert_to_cog(proc_files, outdir_path, compression):
+    """Rewrites preprocessed VV/VH files as Cloud-Optimized GeoTIFFs"""
 
-def cut_preprocessed(proc_files, outdir_path, shp_path, shp_layer, temp_path):
-    """Cuts preprocessed VV/VH files to the exact AOI"""
+    for p_file in proc_files:
+        file_path = Path(outdir_path) / p_file
+        image_temp_out = Path(outdir_path) / f'{Path(p_file).stem}.cog'
+
+        ds = gdal.Translate(str(image_temp_out),
+                    str(file_path),
+                    format = 'COG',
+                    creationOptions = cog_options(compression))
+        ds = None
+
+        os.replace(str(image_temp_out), str(file_path))
+
+    return True
+
+@lru_cache(maxsize=None)
+def read_aoi_bounds(shp_path):
+    """Returns the AOI bounds (minx, miny, maxx, maxy), read once per process"""
+
+    with fiona.open(shp_path) as aoi_shp:
+        return aoi_shp.bounds
+
+def cut_preprocessed(proc_files, outdir_path, shp_path, shp_layer, compression = None):
+    """Cuts preprocessed VV/VH files to the exact AOI.
+    The crop and the cutline are applied in a single warp, so every band is written once.
+    If compression is set the output is a Cloud-Optimized GeoTIFF"""
 
     # Get AOI Upper and Lower x,y
-    aoi_shp = fiona.open(shp_path)
-    ulx_aoi, lry_aoi, lrx_aoi, uly_aoi = aoi_shp.bounds
+    ulx_aoi, lry_aoi, lrx_aoi, uly_aoi = read_aoi_bounds(shp_path)
     
     # Cut preprocessed VV and VH
     for p_file in proc_files:
         file_path = Path(outdir_path) / p_file
 
-        image_temp_out = Path(temp_path) / p_file
+        # Written next to the original so it can be renamed in place
+        image_temp_out = Path(outdir_path) / f'{Path(p_file).stem}.cut'
 
         # Open Image and get corners
         src = gdal.Open(str(file_path))
@@ -38,31 +88,58 @@ def cut_preprocessed(proc_files, outdir_path, shp_path, shp_layer, temp_path):
         print(f"Cutting on: {ulx_crop}, {uly_crop}, {lrx_crop}, {lry_crop}")
         ds = gdal.Warp(str(image_temp_out),
                     str(file_path),
-                    outputBounds = (ulx_crop, uly_crop, lrx_crop, lry_crop),
-                    format = 'GTiff',
-                    multithread=True)
-
-
-        # Delete original
-        os.remove(str(file_path))
-
-        ds = gdal.Warp(str(file_path),
-                    str(image_temp_out),
+                    outputBounds = (ulx_crop, lry_crop, lrx_crop, uly_crop),
+                    xRes = abs(xres), yRes = abs(yres),
                     cutlineDSName = shp_path,
                     cutlineLayer = shp_layer,
                     cropToCutline = False,
-                    format = 'GTiff',
+                    format = 'COG' if compression else 'GTiff',
+                    creationOptions = cog_options(compression) if compression else None,
                     multithread=True)
+        ds = None
 
-        os.remove(str(image_temp_out))
+        # Replace original
+        os.replace(str(image_temp_out), str(file_path))
 
     print('VH, VV files created correctly.')
 
     return True
 
-def preprocess(infile_path, outdir_path, shp_path, shp_layer, temp_path, cut_images = False):
+def scene_subset(footprint, shp_path, spacing=10):
+    """Bounds of the part of the scene that overlaps the AOI polygon.
+    Given the .shp, geocode already processes the scene within the AOI bounding box,
+    so only AOIs that don't fill their bounding box gain from this.
+    Returns the bounds as a pyroSAR subset dict and an estimate of the output pixels
+    (spacing in meters) skipped compared to the bounding box"""
+
+    footprint = wkt.loads(footprint)
+    aoi = read_aoi(shp_path)
+    needed = footprint.intersection(aoi)
+
+    if needed.is_empty:
+        return None, 0
+
+    xmin, ymin, xmax, ymax = needed.bounds
+    subset = {'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax}
+
+    # Areas are in degrees², the EPSG:4326 output grid has square pixels in degrees.
+    # SNAP converts the spacing with the mean earth radius
+    spacing_deg = spacing / math.radians(6371008.7714)
+    skipped = footprint.intersection(aoi.envelope).area - footprint.intersection(needed.envelope).area
+    skipped_pixels = int(skipped / spacing_deg ** 2)
+
+    return subset, skipped_pixels
+
+def preprocess(infile_path, outdir_path, shp_path, shp_layer, temp_path, cut_images = False, gpt_args = None, compression = None, dem_path = None, subset = None, timings = None):
     """Preprocess S1 .zip file to VV/VH .tiff
-    Cutting VV, VH images based on the provided .shp file can be Enabled/Disabled"""
+    Cutting VV, VH images based on the provided .shp file can be Enabled/Disabled.
+    Setting compression (DEFLATE, ZSTD) writes Cloud-Optimized GeoTIFFs.
+    dem_path is the AOI DEM built by init_app.py, SRTM 1Sec HGT is used without it.
+    subset limits the scene to the given bounds, otherwise to the .shp extent.
+    Seconds spent in geocode and in cutting/COG conversion are added to timings"""
+
+    if timings is None:
+        timings = Timings()
 
     # Check if folder exists and if not create it
     Path(outdir_path).mkdir(parents=True, exist_ok=True)
@@ -75,35 +152,37 @@ def preprocess(infile_path, outdir_path, shp_path, shp_layer, temp_path, cut_ima
 
     # Preprocess
     # https://pyrosar.readthedocs.io/en/latest/pyroSAR.html
-    wf_file = util.geocode(
-        infile=infile_path, 
-        outdir=outdir_path, 
-        t_srs=4326, spacing=10, polarizations='all', 
-        shapefile=shp_path,
-        scaling='dB', 
-        geocoding_type='Range-Doppler', 
-        removeS1BorderNoise=True, 
-        removeS1BorderNoiseMethod='pyroSAR', 
-        removeS1ThermalNoise=True, 
-        offset=None, allow_RES_OSV=False, 
-        demName='SRTM 1Sec HGT', 
-        externalDEMFile=None, 
-        externalDEMNoDataValue=None, 
-        externalDEMApplyEGM=True, 
-        terrainFlattening=True, 
-        basename_extensions=None, 
-        test=False, 
-        export_extra=None, groupsize=3, cleanup=True, 
-        tmpdir=temp_path, 
-        gpt_exceptions=None, gpt_args=None, returnWF=True, 
-        nodataValueAtSea=False, 
-        demResamplingMethod='BILINEAR_INTERPOLATION', 
-        imgResamplingMethod='BILINEAR_INTERPOLATION', 
-        alignToStandardGrid=False, standardGridOriginX=0, standardGridOriginY=0, 
-        speckleFilter='Lee', 
-        refarea='gamma0',
-        clean_edges=True
-    )
+    with timings.time('geocode_s'):
+        wf_file = util.geocode(
+            infile=infile_path, 
+            outdir=outdir_path, 
+            t_srs=4326, spacing=10, polarizations='all', 
+            shapefile=subset if subset else shp_path,
+            scaling='dB', 
+            geocoding_type='Range-Doppler', 
+            removeS1BorderNoise=True, 
+            removeS1BorderNoiseMethod='pyroSAR', 
+            removeS1ThermalNoise=True, 
+            offset=None, allow_RES_OSV=False, 
+            demName='SRTM 1Sec HGT', 
+            externalDEMFile=dem_path, 
+            externalDEMNoDataValue=-32768 if dem_path else None, 
+            # The cached DEM already has EGM applied
+            externalDEMApplyEGM=not dem_path, 
+            terrainFlattening=True, 
+            basename_extensions=None, 
+            test=False, 
+            export_extra=None, groupsize=3, cleanup=True, 
+            tmpdir=temp_path, 
+            gpt_exceptions=None, gpt_args=gpt_args, returnWF=True, 
+            nodataValueAtSea=False, 
+            demResamplingMethod='BILINEAR_INTERPOLATION', 
+            imgResamplingMethod='BILINEAR_INTERPOLATION', 
+            alignToStandardGrid=False, standardGridOriginX=0, standardGridOriginY=0, 
+            speckleFilter='Lee', 
+            refarea='gamma0',
+            clean_edges=True
+        )
 
     # Check if preprocess was successful and
     # both .tif files exist
@@ -112,7 +191,12 @@ def preprocess(infile_path, outdir_path, shp_path, shp_layer, temp_path, cut_ima
     # If preprocess was succesful
     if len(proc_files) == 2:
         if cut_images:
-            return cut_preprocessed(proc_files, outdir_path, shp_path, shp_layer, temp_path)
+            with timings.time('cut_s'):
+                return cut_preprocessed(proc_files, outdir_path, shp_path, shp_layer, compression)
+        if compression:
+            with timings.time('cog_s'):
+                return convert_to_cog(proc_files, outdir_path, compression)
+        return True
     else:
         # If WorkFlow file exists, delete it
         if len([s for s in os.listdir(outdir_path) if ".xml" in s]) > 0:
@@ -162,47 +246,247 @@ def dc_create_index_yml(outdir_path):
 
     
 
+def snap_gpt_args(workers, snap_threads, snap_memory):
+    """Split the SNAP thread and memory (GB) budget between the workers.
+    Returns None to use the SNAP defaults if no budget is set"""
+
+    args = []
+    if snap_threads:
+        args += ['-q', str(max(1, snap_threads // workers))]
+    if snap_memory:
+        args += [f'-J-Xmx{max(1, snap_memory // workers)}G']
+
+    return args or None
+
+def raster_grid(file_path):
+    """Read bounds, CRS and shape from the GeoTIFF header, without reading pixels"""
+
+    src = gdal.Open(str(file_path))
+    ulx, xres, xskew, uly, yskew, yres = src.GetGeoTransform()
+    width, height = src.RasterXSize, src.RasterYSize
+    projection = src.GetProjection()
+    src = None
+
+    corners = {
+        'ul': (ulx, uly),
+        'ur': (ulx + width * xres, uly),
+        'll': (ulx, uly + height * yres),
+        'lr': (ulx + width * xres, uly + height * yres)
+    }
+
+    return corners, projection, (height, width)
+
+def create_index_yml(product, outdir_path, product_name='S1_GRD'):
+    """Create the ODC index .yml of a preprocessed product from its s1_products row
+    and the VV/VH GeoTIFF headers, without scanning for datasets.
+    Returns the .yml path, or None if the VV/VH files aren't found"""
+
+    bands = {}
+    for p_file in sorted(os.listdir(outdir_path)):
+        if p_file.endswith('.tif'):
+            for pol in ('VV', 'VH'):
+                if f'_{pol}' in p_file:
+                    bands[pol] = p_file
+
+    if len(bands) != 2:
+        return None
+
+    corners, projection, _ = raster_grid(Path(outdir_path) / bands['VV'])
+
+    # Corners in lat/lon for the extent
+    srs = osr.SpatialReference(wkt=projection)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    to_wgs84 = osr.CoordinateTransformation(srs, wgs84)
+
+    srs.AutoIdentifyEPSG()
+    epsg = srs.GetAuthorityCode(None)
+    spatial_reference = f'EPSG:{epsg}' if epsg else projection
+
+    # Same id every time the product is indexed
+    dataset_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{product_name}/{product['id']}"))
+
+    doc = {
+        'id': dataset_id,
+        'product_type': 'gamma0',
+        'platform': {'code': 'SENTINEL-1'},
+        'instrument': {'name': 'C-SAR'},
+        'format': {'name': 'GTiff'},
+        'extent': {
+            'from_dt': product['beginposition'],
+            'to_dt': product['endposition'],
+            'center_dt': product['beginposition'],
+            'coord': {}
+        },
+        'grid_spatial': {
+            'projection': {
+                'geo_ref_points': {},
+                'spatial_reference': spatial_reference
+            }
+        },
+        'image': {
+            'bands': {pol: {'path': p_file, 'layer': 1} for pol, p_file in bands.items()}
+        },
+        'lineage': {'source_datasets': {}}
+    }
+
+    for corner, (x, y) in corners.items():
+        lon, lat, _ = to_wgs84.TransformPoint(x, y)
+        doc['grid_spatial']['projection']['geo_ref_points'][corner] = {'x': x, 'y': y}
+        doc['extent']['coord'][corner] = {'lat': lat, 'lon': lon}
+
+    # Replace any previous index file
+    for yml_file in [s for s in os.listdir(outdir_path) if s.endswith('.yml')]:
+        os.remove(os.path.join(outdir_path, yml_file))
+
+    yml_path = os.path.join(outdir_path, f"{product['title']}_dcindex.yml")
+    with open(yml_path, 'w') as f:
+        yaml.safe_dump(doc, f, sort_keys=False)
+
+    print('Index files created.')
+    return yml_path
+
+def preprocess_metrics(timings, start):
+    """Metrics of a preprocessed product, picklable to return from a worker process.
+    The memory metrics are maxima over the lifetime of the worker and its SNAP runs"""
+
+    return {**timings.values,
+            'seconds': time.perf_counter() - start,
+            'lifetime_peak_rss_mb': lifetime_peak_rss_mb(),
+            'children_lifetime_peak_rss_mb': lifetime_peak_rss_mb(children=True)}
+
+def preprocess_product(product, dl_path, prep_path, shp_path, shp_layer, temp_path, gpt_args=None, compression=None, dem_path=None, subset_aoi=False, product_name='S1_GRD'):
+    """Preprocess one product in its own temporary folder and create its index yml.
+    Runs in a worker process, returns if it succeeded and its metrics
+    (seconds, geocode/cut seconds, lifetime peak memory of the worker and of SNAP)"""
+
+    start = time.perf_counter()
+    timings = Timings()
+
+    filename = product['title'] + '.zip'
+
+    downloaded_path = os.path.join(dl_path, filename)
+    preprocessed_path = build_preprocessed_path(product, prep_path)
+
+    # Isolated temporary folder so concurrent SNAP runs don't collide
+    Path(temp_path).mkdir(parents=True, exist_ok=True)
+    worker_temp = tempfile.mkdtemp(prefix=f"{product['title']}_", dir=temp_path)
+
+    # Only send the part of the scene that overlaps the AOI polygon through SNAP
+    subset = None
+    if subset_aoi and product['footprint']:
+        subset, skipped_pixels = scene_subset(product['footprint'], shp_path)
+        print(f"{product['title']}: ~{skipped_pixels:,} pixels of the AOI bounding box outside the AOI skipped")
+
+    print(f'Preprocessing: ', filename)
+    try:
+        if preprocess(downloaded_path, preprocessed_path, shp_path, shp_layer, worker_temp, gpt_args=gpt_args, compression=compression, dem_path=dem_path, subset=subset, timings=timings):
+
+            # Create yml for datacube index from what is already known,
+            # scan the folder with pyroSAR only if that isn't possible
+            with timings.time('index_yml_s'):
+                if not create_index_yml(product, preprocessed_path, product_name):
+                    dc_create_index_yml(preprocessed_path)
+
+            return True, preprocess_metrics(timings, start)
+    finally:
+        shutil.rmtree(worker_temp, ignore_errors=True)
+
+    return False, preprocess_metrics(timings, start)
+
+def read_preprocess_config(config, workers=1):
+    """Arguments of preprocess_product shared by preprocess_products.py and the orchestrator"""
+
+    shp_path = config['Preprocess']['SHP']
+
+    # Reuse the AOI DEM if it was built for the current AOI
+    dem_path = config['Preprocess'].get('DEM_File') or None
+    if dem_path and not dem_cache_valid(dem_path, shp_path):
+        print(f'{dem_path} is missing or outdated, run init_app.py. Using SRTM 1Sec HGT')
+        dem_path = None
+
+    return {
+        'dl_path': config['Path']['Download'],
+        'prep_path': config['Path']['Preprocess'],
+        'shp_path': shp_path,
+        'shp_layer': config['Preprocess']['Layer'],
+        'temp_path': config['Path']['Temporary'],
+        # Parallel SNAP runs share the thread and memory budget
+        'gpt_args': snap_gpt_args(workers,
+                                  int(config['Preprocess'].get('SNAP_Threads') or 0),
+                                  int(config['Preprocess'].get('SNAP_Memory') or 0)),
+        'compression': config['Preprocess'].get('COG_Compression') or None,
+        'dem_path': dem_path,
+        'subset_aoi': config.getboolean('Preprocess', 'Subset_AOI', fallback=True),
+        'product_name': config['Preprocess']['Product_Name']
+    }
+
+
 if __name__ == '__main__':
     
     # Load Config
     config = read_config('config.ini')
     
-    shp_path = config['Preprocess']['SHP']
-    shp_layer = config['Preprocess']['Layer']
-    dl_path = config['Path']['Download']
-    prep_path =  config['Path']['Preprocess']
-    temp_path = config['Path']['Temporary']
+    min_coverage = config.getfloat('Preprocess', 'Min_Coverage', fallback=0)
+    workers = config.getint('Preprocess', 'Workers', fallback=1)
+    options = read_preprocess_config(config, workers)
+
+    lease_seconds = config.getfloat('Database', 'Lease_Seconds', fallback=300)
+    retry_delay = config.getfloat('Database', 'Retry_Delay', fallback=600)
 
     # Create SQLite connection
     con = create_connection(config['Path']['Database'])
     con.row_factory = sqlite3.Row
     cur = con.cursor()
 
-    # Get downloaded but not preprocessed products
-    products_down = cur.execute('SELECT * FROM s1_products WHERE downloaded=1 AND preprocessed=0 ORDER BY beginposition DESC')
-    products_down = [dict(row) for row in cur.fetchall()]
+    # Lease the downloaded but not preprocessed products, so orchestrators and other runs skip them
+    owner = lease_owner()
+    products_down = claim(con, 'preprocess', owner, lease_seconds, None, min_coverage)
     
     try:
         # For every downloaded product preprocess to VV, VH images
         if products_down:
-            for product in products_down:
-                filename = product['title'] + '.zip'
+            start = time.perf_counter()
+            timings = []
 
-                downloaded_path = os.path.join(dl_path, filename)
-                preprocessed_path = build_preprocessed_path(product, prep_path)
-            
-                print(f'Preprocessing: ', filename)
-                if preprocess(downloaded_path, preprocessed_path, shp_path, shp_layer, temp_path):
+            # Workers only run SNAP, DB updates happen in this process
+            with Heartbeat(config['Path']['Database'], owner, [product['id'] for product in products_down], lease_seconds), \
+                    ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(preprocess_product, product, **options): product for product in products_down}
 
-                    # Create yml for datacube index
-                    dc_create_index_yml(preprocessed_path)
+                for future in as_completed(futures):
+                    product = futures[future]
+
+                    try:
+                        success, metrics = future.result()
+                    except Exception as e:
+                        print(f"Failed to preprocess {product['title']}: {e}")
+                        with con:
+                            complete(cur, product['id'], owner, {}, retry_delay)
+                        continue
+
+                    seconds = metrics['seconds']
+                    timings.append((product['title'], success, seconds))
+                    print(f"Preprocessed {product['title']} in {seconds:.1f}s" if success else f"Preprocess of {product['title']} failed after {seconds:.1f}s")
 
                     # Commit to DB
-                    cur.execute('UPDATE s1_products SET preprocessed = 1 WHERE id = ?', (product['id'],))
-                    con.commit()
+                    with con:
+                        complete(cur, product['id'], owner, {'preprocessed': 1} if success else {}, None if success else retry_delay)
+                        record_metrics(cur, product['id'], 'preprocess', metrics)
+
+            # Throughput summary
+            elapsed = time.perf_counter() - start
+            done = sum(1 for _, success, _ in timings if success)
+            print(f'Preprocessed {done}/{len(products_down)} products in {elapsed:.1f}s with {workers} workers')
+            if done:
+                print(f'{elapsed / done:.1f}s per product, {done * 3600 / elapsed:.2f} products/hour')
         else:
             print('No products to preprocess')
     except KeyboardInterrupt:
         print('Exiting...')
     finally:
+        # The worker processes have stopped, give back the products they didn't finish
+        release(con, owner)
         con.close()
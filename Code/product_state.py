@@ -0,0 +1,137 @@
+from utils import create_connection
+import os
+import time
+import socket
+import sqlite3
+import threading
+
+# Stage a product is waiting for, kept in the status column by triggers
+# whenever the downloaded/preprocessed/indexed/detected flags change
+STAGES = ('download', 'preprocess', 'index', 'predict')
+
+STATUS_CASE = """CASE WHEN NEW.downloaded = 0 THEN 'download'
+        WHEN NEW.preprocessed = 0 THEN 'preprocess'
+        WHEN NEW.indexed = 0 THEN 'index'
+        WHEN NEW.detected = 0 THEN 'predict'
+        ELSE 'done' END"""
+
+
+def status_schema(table):
+    """SQL statements of the status index and triggers, safe to run again"""
+
+    return [
+        'CREATE INDEX IF NOT EXISTS ix_{0}_status ON {0} (status, beginposition)'.format(table),
+        '''CREATE TRIGGER IF NOT EXISTS {0}_status_insert AFTER INSERT ON {0}
+    BEGIN UPDATE {0} SET status = {1} WHERE id = NEW.id; END'''.format(table, STATUS_CASE),
+        '''CREATE TRIGGER IF NOT EXISTS {0}_status_update AFTER UPDATE OF downloaded, preprocessed, indexed, detected ON {0}
+    BEGIN UPDATE {0} SET status = {1} WHERE id = NEW.id; END'''.format(table, STATUS_CASE),
+    ]
+
+def backfill_status(table):
+    """SQL setting the status of rows written before the status column existed"""
+    return 'UPDATE {0} SET status = {1} WHERE status IS NULL'.format(table, STATUS_CASE.replace('NEW.', ''))
+
+def lease_owner():
+    """Name of this worker process in the lease_owner column"""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def claim(con, stage, owner, lease_seconds, limit=1, min_coverage=None, table='s1_products'):
+    """Lease up to limit (None for all) products waiting for stage, newest first.
+    Every row is taken with a conditional UPDATE, so concurrent workers never get the same product.
+    Returns the claimed products as dicts"""
+
+    now = time.time()
+
+    sql = 'SELECT * FROM {} WHERE status = ? AND (lease_expires IS NULL OR lease_expires < ?)'.format(table)
+    params = [stage, now]
+    if min_coverage is not None:
+        sql += ' AND (coverage IS NULL OR coverage >= ?)'
+        params.append(min_coverage)
+    sql += ' ORDER BY beginposition DESC LIMIT ?'
+    params.append(-1 if limit is None else limit)
+
+    rows = con.execute(sql, params).fetchall()
+
+    claimed = []
+    with con:
+        for row in rows:
+            cur = con.execute('''UPDATE {} SET lease_owner = ?, lease_expires = ?
+                WHERE id = ? AND status = ? AND (lease_expires IS NULL OR lease_expires < ?)'''.format(table),
+                (owner, now + lease_seconds, row['id'], stage, now))
+
+            # Taken by another worker since the SELECT
+            if cur.rowcount == 1:
+                claimed.append(dict(row))
+
+    return claimed
+
+def renew(con, owner, ids, lease_seconds, table='s1_products'):
+    """Heartbeat: extend the leases of owner on ids. Returns the number still held"""
+
+    if not ids:
+        return 0
+
+    ids = list(ids)
+    with con:
+        cur = con.execute('UPDATE {} SET lease_expires = ? WHERE lease_owner = ? AND id IN ({})'.format(
+            table, ', '.join('?' * len(ids))), [time.time() + lease_seconds, owner] + ids)
+
+    return cur.rowcount
+
+def complete(cur, product_id, owner, values, retry_after=None, table='s1_products'):
+    """Write the stage result of a leased product and give up its lease.
+    With retry_after (seconds) no worker claims the product again until then.
+    Returns False if the lease had expired and was taken by another worker"""
+
+    columns = ''.join(f'{column} = ?, ' for column in values)
+    expires = time.time() + retry_after if retry_after else None
+
+    cur.execute('UPDATE {} SET {}lease_owner = NULL, lease_expires = ? WHERE id = ? AND lease_owner = ?'.format(table, columns),
+                list(values.values()) + [expires, product_id, owner])
+
+    return cur.rowcount == 1
+
+
+def release(con, owner, table='s1_products'):
+    """Give up every lease still held by owner, e.g. of products that never started before an exit"""
+
+    with con:
+        con.execute('UPDATE {} SET lease_owner = NULL, lease_expires = NULL WHERE lease_owner = ?'.format(table), (owner,))
+
+
+class Heartbeat(threading.Thread):
+    """Renews the leases of owner on ids every third of the lease time while a stage runs.
+    Uses its own connection, so the stage can keep the thread it runs on"""
+
+    def __init__(self, db_path, owner, ids, lease_seconds, table='s1_products'):
+        super().__init__(daemon=True)
+        self.db_path = db_path
+        self.owner = owner
+        self.ids = list(ids)
+        self.lease_seconds = lease_seconds
+        self.table = table
+        self.stopped = threading.Event()
+
+    def run(self):
+        con = create_connection(self.db_path)
+        try:
+            while not self.stopped.wait(self.lease_seconds / 3):
+                # A busy database only delays this renewal, the lease is still valid
+                try:
+                    renew(con, self.owner, self.ids, self.lease_seconds, self.table)
+                except sqlite3.Error as e:
+                    print(f'Lease renewal failed: {e}')
+        finally:
+            con.close()
+
+    def stop(self):
+        """Stop renewing and wait for the thread"""
+        self.stopped.set()
+        self.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -1,6 +1,10 @@
-from utils import create_connection, read_config
-import requests
+from utils import create_connection, read_config, read_aoi, backoff_delay, RateLimiter
+from download_products import RETRY_STATUS
+from metrics import Timings, record_metrics, lifetime_peak_rss_mb
 import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from shapely import wkt
 from datetime import datetime, timedelta
 
 keys = ['uuid', 'identifier', 'filename', 'beginposition', 'endposition', 'orbitnumber',  
@@ -13,6 +17,27 @@ def read_polygon(polygon_path):
     
     return polygon
 
+def compute_coverage(footprint, aoi):
+    """Fraction of the AOI area covered by a product footprint (WKT)"""
+    footprint = wkt.loads(footprint)
+
+    if aoi.area == 0:
+        return 0.0
+
+    return footprint.intersection(aoi).area / aoi.area
+
+def update_coverage(con, table_name, aoi):
+    """Compute the AOI coverage of every product that doesn't have it yet"""
+    cur = con.cursor()
+    products = cur.execute('SELECT id, footprint FROM {} WHERE coverage IS NULL'.format(table_name)).fetchall()
+
+    rows = [(compute_coverage(footprint, aoi), prd_id) for prd_id, footprint in products]
+
+    with con:
+        cur.executemany('UPDATE {} SET coverage = ? WHERE id = ?'.format(table_name), rows)
+
+    return len(rows)
+
 def get_page(res):
     """Get one page of results from OpenSearch"""
 
@@ -43,41 +68,82 @@ def get_page(res):
     
     return product_list
             
-def get_products(session, os_url):
+def fetch_page(session, os_url, limiter=None, timings=None, retries=5, backoff=2, backoff_max=60):
+    """Request one OpenSearch page and return the parsed JSON.
+    Retryable statuses and connection errors back off with jitter, the last error is raised.
+    The request time and the retries are added to timings"""
+
+    for attempt in range(retries + 1):
+        if attempt:
+            delay = backoff_delay(attempt - 1, backoff, backoff_max)
+            print(f'Retrying page in {delay:.1f}s ({attempt}/{retries})')
+            if timings is not None:
+                timings.add('retries', 1)
+            time.sleep(delay)
+
+        if limiter:
+            limiter.wait()
+
+        start = time.perf_counter()
+        try:
+            r = session.get(os_url, timeout=60)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt == retries:
+                raise
+            continue
+        finally:
+            if timings is not None:
+                seconds = time.perf_counter() - start
+                timings.add('pages', 1)
+                timings.add('page_s', seconds)
+                timings.peak('page_max_s', seconds)
+
+        # Quota exceeded, throttled or server errors
+        if r.status_code in RETRY_STATUS and attempt < retries:
+            continue
+
+        r.raise_for_status()
+        return r.json()
+
+def get_products(session, os_url, rows=100, workers=4, limiter=None, timings=None, retries=5, backoff=2):
     """Returns all found products. 
-    Returns None if no products are found"""
-
-    page = 0
-    product_page = []
-    product_list = []
+    Returns None if no products are found.
+    The first page reports totalResults, the remaining start= offsets are fetched concurrently.
+    A page that still fails after its retries drops the newer pages too, so the next sync,
+    which starts after the newest synced product, fetches them again"""
 
-    while len(product_page) == 100 or page == 0:
-        r = session.get(os_url)
+    res = fetch_page(session, os_url, limiter, timings, retries, backoff)
 
-        try:
-            r.raise_for_status()
-            res = r.json()
-
-            # Check for 0 results
-            if 'entry' not in res['feed']:
-                return
+    # Check for 0 results
+    if 'entry' not in res['feed']:
+        return
 
-            product_page = get_page(res)
-            product_list.extend(product_page)
+    pages = [get_page(res)]
 
-            # Get 'next' link            
-            for link in res['feed']['link']:
-                if link['rel'] == 'next':
-                    os_url = link['href']
-            
-            page += 1
+    total = int(res['feed'].get('opensearch:totalResults', len(pages[0])))
+    offsets = range(rows, total, rows)
 
-        except requests.exceptions.HTTPError as e:
-            raise e
-        
-        time.sleep(0.5)
+    page_urls = [os_url.replace('&start=0&', f'&start={offset}&') for offset in offsets]
 
-    return product_list
+    def fetch(url):
+        try:
+            return fetch_page(session, url, limiter, timings, retries, backoff)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f'Failed to fetch page {url}: {e}')
+            if timings is not None:
+                timings.add('failed_pages', 1)
+            return None
+
+    # Keep the pages in offset order so products stay sorted by beginposition
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for res in executor.map(fetch, page_urls):
+            if res is None:
+                # Pages are newest first, keep only those older than the failed one
+                pages = []
+            elif 'entry' in res['feed']:
+                pages.append(get_page(res))
+
+    return [product for page in pages for product in page]
 
 if __name__ == '__main__':
 
@@ -121,14 +187,24 @@ footprint:"Intersects({polygon})"\
     session = requests.Session()
     session.auth = (config['Scihub']['Username'], config['Scihub']['Password'])
 
-    products = get_products(session, os_url)
+    workers = config.getint('Scihub', 'Page_Workers', fallback=4)
+    limiter = RateLimiter(config.getfloat('Scihub', 'Requests_Per_Second', fallback=2))
+
+    retries = config.getint('Scihub', 'Retries', fallback=5)
+    backoff = config.getfloat('Scihub', 'Backoff', fallback=2)
+
+    timings = Timings()
+    with timings.time('seconds'):
+        products = get_products(session, os_url, workers=workers, limiter=limiter, timings=timings,
+                                retries=retries, backoff=backoff)
+
+    if timings.values.get('failed_pages'):
+        print(f"{timings.values['failed_pages']:.0f} result pages failed, newer products will be synced next run")
 
     if products:
         print("Products to sync: ", len(products))
 
-        # Get list of existing products
-        products_exist = list(prd[0] for prd in cur.execute('SELECT id FROM {}'.format(table_name)).fetchall())
-
+        rows = []
         beginposition = ""
 
         for product in products:
@@ -137,15 +213,17 @@ footprint:"Intersects({polygon})"\
                 continue
             beginposition = product['beginposition']
 
-            # Insert product in database
-            if product['uuid'] not in products_exist:
-                cur.execute('INSERT INTO {} values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(table_name), (
-                    product['uuid'], product['identifier'], product['filename'], product['beginposition'], product['endposition'], 
-                    product['orbitnumber'], product['orbitdirection'], product['footprint'], product['info_link'], product['dl_link'], 
-                    "", 0, 0, 0, 0
-                ))
+            rows.append((
+                product['uuid'], product['identifier'], product['filename'], product['beginposition'], product['endposition'], 
+                product['orbitnumber'], product['orbitdirection'], product['footprint'], product['info_link'], product['dl_link'], 
+                "", 0, 0, 0, 0
+            ))
 
-        con.commit()
+        # Insert all products in one transaction, existing ids are ignored
+        with con:
+            cur.executemany('''INSERT OR IGNORE INTO {} (id, title, filename, beginposition, endposition, orbitnumber, orbitdirection, 
+                footprint, info_link, dl_link, checksum, downloaded, preprocessed, indexed, detected) 
+                values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''.format(table_name), rows)
 
         # Print the most recent synced product
         last_product = cur.execute('SELECT beginposition FROM {} ORDER BY beginposition DESC LIMIT 1'.format(table_name)).fetchall()
@@ -153,5 +231,13 @@ footprint:"Intersects({polygon})"\
     else:
         print("No products to sync")
 
-    con.close()
+    # Calculate the overlap with the full resolution AOI
+    # for the new products and any synced before coverage existed
+    aoi = read_aoi(config['Preprocess']['SHP'])
+    print("Coverage calculated for: ", update_coverage(con, table_name, aoi))
+
+    # Run level metrics of the sync
+    with con:
+        record_metrics(con.cursor(), '', 'sync', {**timings.values, 'products': len(products or []), 'lifetime_peak_rss_mb': lifetime_peak_rss_mb()})
 
+    con.close()
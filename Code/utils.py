@@ -1,12 +1,24 @@
 import os
+import fcntl
+import signal
+import random
+import threading
+import time
 import sqlite3
 import configparser
+import hashlib
+import json
+from functools import lru_cache
 
-def create_connection(db_file):
-    """Create a database connection to an SQLite database"""
+def create_connection(db_file, timeout=30):
+    """Create a database connection to an SQLite database.
+    The journal mode is stored in the database by init_app.py, busy connections wait up to timeout seconds"""
     con = None
     try:
-        con = sqlite3.connect(db_file)
+        con = sqlite3.connect(db_file, timeout=timeout)
+        if con.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+            # Durable at checkpoints, still consistent after a crash
+            con.execute('PRAGMA synchronous=NORMAL')
     except sqlite3.Error as e:
         print(e)
 
@@ -27,4 +39,116 @@ def build_preprocessed_path(product, preprocessed_path):
     
     full_preprocessed_path = os.path.join(preprocessed_path, sat, folder)
 
-    return full_preprocessed_path
\ No newline at end of file
+    return full_preprocessed_path
+
+@lru_cache(maxsize=None)
+def read_aoi(shp_path):
+    """Returns the full resolution AOI polygon of the shapefile"""
+    import fiona
+    from shapely.geometry import shape
+
+    with fiona.open(shp_path) as c:
+        aoi = shape(next(iter(c))['geometry'])
+
+    return aoi
+
+def file_fingerprint(file_path):
+    """MD5 of the contents of a file"""
+
+    file_hash = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+def shapefile_fingerprint(shp_path):
+    """MD5 of the shapefile geometry and projection files, used to detect AOI changes"""
+
+    file_hash = hashlib.md5()
+    for ext in ('.shp', '.shx', '.prj'):
+        part = os.path.splitext(shp_path)[0] + ext
+        if os.path.isfile(part):
+            with open(part, 'rb') as f:
+                file_hash.update(f.read())
+
+    return file_hash.hexdigest()
+
+def dem_cache_valid(dem_path, shp_path):
+    """Check that the cached AOI DEM exists and was built from the current AOI"""
+
+    try:
+        with open(dem_path + '.json') as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    return os.path.isfile(dem_path) and info.get('aoi') == shapefile_fingerprint(shp_path)
+
+def backoff_delay(attempt, base, cap):
+    """Exponential backoff with full jitter for the given retry attempt"""
+
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RateLimiter:
+    """Thread safe limiter spacing calls at least 1/rate seconds apart"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next call is allowed"""
+
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+def daemon_pid_path(config):
+    """PID file of the prediction daemon"""
+    return config['Predict'].get('Daemon_Pid') or os.path.join(config['Path']['Temporary'], 'predict_daemon.pid')
+
+def hold_pid_file(pid_path):
+    """Lock the PID file for the lifetime of this process and write the PID to it.
+    Returns the open file, which keeps the lock until it is closed, or None if another process holds it"""
+
+    while True:
+        f = open(pid_path, 'a+')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return None
+
+        # The previous owner may have removed the file after it was opened, lock the one at the path
+        try:
+            if os.stat(pid_path).st_ino == os.fstat(f.fileno()).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        f.close()
+
+    f.truncate(0)
+    f.write(str(os.getpid()))
+    f.flush()
+
+    return f
+
+def notify_daemon(pid_path):
+    """Wake the prediction daemon up if it is running.
+    Only signalled while the daemon holds the lock on its PID file,
+    so a stale file never gets the PID of another process signalled"""
+    try:
+        with open(pid_path) as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.kill(int(f.read()), signal.SIGUSR1)
+    except (OSError, ValueError):
+        pass